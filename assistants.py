@@ -1,43 +1,566 @@
+from aiogram.utils.exceptions import NetworkError, RetryAfter, TelegramAPIError
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from MySQLdb.connections import Connection
-from MySQLdb._exceptions import Error, OperationalError
+from MySQLdb._exceptions import Error, OperationalError, ProgrammingError
+from scoring import Leaderboard, decode_answers, encode_answers
 import MySQLdb as msdb
+import asyncio
+import functools
+import inspect
+import math
 import random as rm
 import re
+import threading
 import time
 
 
+DB_HOST = ''
+DB_NAME = ''
+DB_USER = ''
+DB_PASSWORD = ''
+# Connection pool settings. Idle connections above POOL_MIN_SIZE are closed after POOL_IDLE_TIMEOUT seconds,
+# connections that have been idle longer than POOL_HEALTH_CHECK_INTERVAL seconds are pinged before reuse.
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = 10
+POOL_IDLE_TIMEOUT = 300
+POOL_HEALTH_CHECK_INTERVAL = 30
+POOL_ACQUIRE_TIMEOUT = 10
+# The number of threads that run the queries of the async models. More threads than pooled connections would only wait.
+DB_EXECUTOR_WORKERS = POOL_MAX_SIZE
+# Seconds the latest channel is kept in memory, it is also dropped as soon as a channel is added.
+CHANNEL_CACHE_TTL = 300
+# The number of users whose rows are kept in memory, the least recently used ones are dropped first.
+USER_CACHE_SIZE = 10000
+# The number of active tests kept in memory along with their parsed answer keys.
+TEST_REGISTRY_SIZE = 1000
+# Limits of Sender: messages per second in total, seconds between two messages to the same chat, 
+# messages being sent at once and retries of a message that failed with a temporary error.
+SENDER_RATE = 25
+SENDER_CHAT_INTERVAL = 1
+SENDER_CONCURRENCY = 20
+SENDER_MAX_RETRIES = 3
+# The number of pending messages the outbox sends at once, and seconds it waits before looking for new ones.
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_POLL_INTERVAL = 5
+# Seconds Outbox.deliver waits for its messages, the ones that are not sent by then stay pending for the worker.
+OUTBOX_DELIVER_TIMEOUT = 600
+# Seconds the delivered and failed messages are kept in the outbox, and seconds between two purges of the older ones.
+OUTBOX_KEEP_SENT = 7 * 24 * 60 * 60
+OUTBOX_PURGE_INTERVAL = 60 * 60
+# The number of rows sent in one multi-row INSERT by Storekeeper.get_supplies_in_bulk.
+BULK_INSERT_CHUNK_SIZE = 500
+# Retries of the question_stats update of a submission that hit a lock wait timeout or a deadlock.
+QUESTION_STATS_RETRIES = 3
+# The number of rows fetched at once by the iter_* methods of the models, e.g. for the exports.
+FETCH_CHUNK_SIZE = 1000
+# Test ids are handed out by Test.allocate_test_id in the order of a keyed permutation of the range: the n-th id is
+# TEST_ID_MIN + (n * TEST_ID_MULTIPLIER + TEST_ID_OFFSET) % (TEST_ID_MAX - TEST_ID_MIN + 1). The multiplier should 
+# have no common divisor with the size of the range. Never change these once tests have been added.
+TEST_ID_MIN = 10000
+TEST_ID_MAX = 99999
+TEST_ID_MULTIPLIER = 7919
+TEST_ID_OFFSET = 31337
+
+
+class ConnectionPool:
+    """
+    A class for keeping a bounded number of database connections open and handing them out for reuse.
+    """
+
+    def __init__(
+            self,
+            min_size: int = POOL_MIN_SIZE,
+            max_size: int = POOL_MAX_SIZE,
+            idle_timeout: int | float = POOL_IDLE_TIMEOUT,
+            health_check_interval: int | float = POOL_HEALTH_CHECK_INTERVAL,
+            acquire_timeout: int | float = POOL_ACQUIRE_TIMEOUT,
+    ):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise ValueError('Invalid pool size! MIN_SIZE should be between 0 and MAX_SIZE, MAX_SIZE at least 1.')
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        # (connection, time it was returned to the pool); the most recently returned one is on the right.
+        self._idle = deque()
+        self._size = 0
+        self._condition = threading.Condition()
+    
+
+    def acquire(self) -> Connection:
+        """
+        Takes an idle connection from the pool, or opens a new one if the pool is not full yet.
+
+        Waits for a connection to be released when all of them are in use, 
+        raises TimeoutError if none is released within ACQUIRE_TIMEOUT seconds.
+        """
+
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._condition:
+            while True:
+                self._close_expired()
+                if self._idle:
+                    connection, released_at = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    connection, released_at = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._condition.wait(remaining):
+                    raise TimeoutError('No database connection was released in %s seconds!' % self.acquire_timeout)
+        
+        if connection is None:
+            try:
+                return self._connect()
+            except Exception:
+                self._forget()
+                raise
+        if time.monotonic() - released_at > self.health_check_interval:
+            try:
+                connection.ping()
+            except Error:
+                self._close_quietly(connection)
+                try:
+                    return self._connect()
+                except Exception:
+                    self._forget()
+                    raise
+        return connection
+
+
+    def close_all(self):
+        """
+        Closes all the idle connections in the pool.
+        """
+
+        with self._condition:
+            while self._idle:
+                connection, _ = self._idle.popleft()
+                self._close_quietly(connection)
+                self._size -= 1
+            self._condition.notify_all()
+
+
+    def discard(self, connection: Connection):
+        """
+        Closes a broken connection instead of returning it to the pool.
+        """
+
+        self._close_quietly(connection)
+        self._forget()
+
+
+    def release(self, connection: Connection):
+        """
+        Returns the connection to the pool so that it can be reused.
+        """
+
+        if not connection.open:
+            self._forget()
+            return
+        with self._condition:
+            self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+
+    def _close_expired(self):
+        """
+        Closes the connections that have been idle longer than IDLE_TIMEOUT, keeping at least MIN_SIZE of them.
+
+        NOTE: should be called with the lock held.
+        """
+
+        now = time.monotonic()
+        while len(self._idle) > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            connection, _ = self._idle.popleft()
+            self._close_quietly(connection)
+            self._size -= 1
+
+
+    def _close_quietly(self, connection: Connection):
+        """
+        Closes the connection ignoring the errors of already broken connections.
+        """
+
+        try:
+            connection.close()
+        except Error:
+            pass
+        else:
+            print('Database connection closed successfully!')
+
+
+    def _connect(self) -> Connection:
+        """
+        Opens a new connection to the database.
+        """
+
+        connection: Connection = msdb.connect(
+            host=DB_HOST,
+            database=DB_NAME,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            autocommit=True,
+        )
+        print('Database connection made successfully!')
+        return connection
+
+
+    def _forget(self):
+        """
+        Frees the slot of a connection that is not in the pool anymore.
+        """
+
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+
+_pool: ConnectionPool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """
+    Returns the connection pool of the process, creating it on the first call.
+    """
+
+    global _pool
+
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+
 class DB:
     """
     A class for manipulating database.
+
+    Connections are taken from and returned to the connection pool of the process, 
+    they are opened in autocommit mode.
     """
 
     def make_connection(self) -> Connection:
         """
-        Connects to the database.
+        Takes a connection from the pool.
         """
 
         try:
-            db: Connection = msdb.connect(
-                host='',
-                database='',
-                user='',
-                password=''
-            )
-        except Error as e:
+            db: Connection = get_pool().acquire()
+        except (Error, TimeoutError) as e:
             print('An error happened while trying to connect to the database: ', e)
         else:
-            print('Database connection made successfully!')
             return db
 
     
     def close_connection(self, connection: Connection, cursor: msdb.cursors.Cursor):
         """
-        Closes the opened connection along with the cursor.
+        Closes the cursor and returns the connection to the pool.
         """
 
         cursor.close()
-        connection.close()
-        print('Database connection closed successfully!')
+        get_pool().release(connection)
+
+
+    @contextmanager
+    def get_cursor(self, unbuffered: bool = False):
+        """
+        Takes a connection from the pool and yields a cursor of it. 
+        
+        The connection is returned to the pool when the block is left, or closed if it turned out to be broken.
+        Set unbuffered to True to get a server-side cursor (SSCursor), which reads the rows from the server 
+        as they are fetched instead of loading the whole result into memory at once. 
+        The rows of such a cursor should be fetched without delay, the server gives up on a reader that 
+        stalls longer than its net_write_timeout.
+        """
+
+        pool = get_pool()
+        connection = pool.acquire()
+        try:
+            cursor: msdb.cursors.Cursor = connection.cursor(msdb.cursors.SSCursor if unbuffered else None)
+        except Error:
+            pool.discard(connection)
+            raise
+        broken = False
+        try:
+            yield cursor
+        except OperationalError:
+            broken = True
+            raise
+        finally:
+            try:
+                # Reads the rows left unread over the network, when the cursor is unbuffered.
+                cursor.close()
+            except Exception:
+                broken = True
+            finally:
+                if broken:
+                    pool.discard(connection)
+                else:
+                    pool.release(connection)
+
+
+_executor: ThreadPoolExecutor = None
+# Returned by next instead of raising StopIteration, which cannot be passed through a future, see AsyncModel.
+_EXHAUSTED = object()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Returns the thread pool that runs the queries of the async models, creating it on the first call.
+    """
+
+    global _executor
+
+    if _executor is None:
+        with _pool_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix='db')
+    return _executor
+
+
+class AsyncModel:
+    """
+    A class for using the models from coroutines without blocking the event loop.
+
+    Wraps a model instance and exposes the same methods, but as coroutine functions that run the 
+    original method in the database thread pool. Generator methods are exposed as async generators 
+    which take every item of the original generator in the thread pool. Attributes that are not callable 
+    are returned as they are.
+
+    Example:
+        user_model = AsyncModel(User())
+        user = await user_model.get_user_or_users('chat_id', chat_id)
+        async for user in user_model.iter_users():
+            ...
+    """
+
+    def __init__(self, model):
+        self.model = model
+
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self.model, name)
+        if not callable(attribute):
+            return attribute
+
+        if inspect.isgeneratorfunction(attribute):
+            @functools.wraps(attribute)
+            async def iterate_in_executor(*args, **kwargs):
+                loop = asyncio.get_running_loop()
+                iterator = attribute(*args, **kwargs)
+                try:
+                    while True:
+                        item = await loop.run_in_executor(get_executor(), next, iterator, _EXHAUSTED)
+                        if item is _EXHAUSTED:
+                            break
+                        yield item
+                finally:
+                    # Releases what the generator holds, e.g. the connection of a server-side cursor.
+                    await loop.run_in_executor(get_executor(), iterator.close)
+
+            return iterate_in_executor
+
+        @functools.wraps(attribute)
+        async def run_in_executor(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(get_executor(), functools.partial(attribute, *args, **kwargs))
+
+        return run_in_executor
+
+
+class LRUCache:
+    """
+    A class for keeping a bounded number of values in memory, dropping the least recently used ones first.
+
+    Counts the hits and misses of the get method. The cache can be used from several threads at once.
+    """
+
+    def __init__(self, max_size: int):
+        if max_size < 1:
+            raise ValueError('MAX_SIZE should be at least 1!')
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Incremented on every change made by update or invalidate, see the set method.
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, key, default=None):
+        """
+        Returns the value of the key, or the default if there is no such key.
+        """
+
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+
+    def invalidate(self, key=None):
+        """
+        Drops the given key, or every key if none is given.
+        """
+
+        with self._lock:
+            self.generation += 1
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+    def set(self, key, value, generation: int = None):
+        """
+        Sets the value of the key.
+
+        Pass the generation read before loading the value to skip storing it when the cache has been 
+        changed in the meantime, so that a value loaded before a change does not outlive the change.
+        """
+
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+    def stats(self) -> dict:
+        """
+        Returns the size of the cache along with the number of hits and misses.
+        """
+
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+    def update(self, key, fields: dict):
+        """
+        Updates the fields of the dictionary stored under the key, if the key is cached.
+        """
+
+        with self._lock:
+            self.generation += 1
+            value = self._entries.get(key)
+            if isinstance(value, dict):
+                self._entries[key] = {**value, **fields}
+
+
+class TTLCache:
+    """
+    A class for keeping values in memory for a limited time.
+
+    Every entry expires TTL seconds after it was set, unless another ttl is given for it. When MAX_SIZE is given 
+    and the cache is full, the oldest entries are dropped to make room for new ones, whether they have expired or not.
+    The cache can be used from several threads at once.
+    """
+
+    def __init__(self, ttl: int | float, max_size: int = None):
+        self.ttl = ttl
+        self.max_size = max_size
+        # Incremented on every invalidation, see the set method.
+        self.generation = 0
+        # key -> (value, expiry time); the most recently set entry is on the right.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, key, default=None):
+        """
+        Returns the value of the key, or the default if there is no such key or it has expired.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                return default
+            return value
+
+
+    def invalidate(self, key=None):
+        """
+        Drops the given key, or every key if none is given.
+        """
+
+        with self._lock:
+            self.generation += 1
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+    def set(self, key, value, ttl: int | float = None, generation: int = None):
+        """
+        Sets the value of the key.
+
+        Pass the generation read before loading the value to skip storing it when the cache has been 
+        invalidated in the meantime, so that a value loaded before a change does not outlive the change.
+        """
+
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries.pop(key, None)
+            if self.max_size is not None and len(self._entries) >= self.max_size:
+                self._make_room()
+            self._entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+
+
+    def _make_room(self):
+        """
+        Drops the expired entries from the front of the cache, and then the oldest ones while it is still full.
+
+        Only the front is looked at, so making room costs O(1) per dropped entry instead of a scan of the cache.
+        Expired entries further back are dropped when they reach the front or are read.
+
+        NOTE: should be called with the lock held.
+        """
+
+        now = time.monotonic()
+        while self._entries and now >= next(iter(self._entries.values()))[1]:
+            self._entries.popitem(last=False)
+        while len(self._entries) >= self.max_size:
+            self._entries.popitem(last=False)
+
+
+class VersionCounter:
+    """
+    A class for counting the changes of some data, so that anything built from the data can tell if it is outdated.
+
+    The counter starts from 0 in every process. It can be used from several threads at once.
+    """
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+
+    def bump(self) -> int:
+        """
+        Increments the version and returns the new one.
+        """
+
+        with self._lock:
+            self.value += 1
+            return self.value
 
 
 class Channel:
@@ -45,40 +568,61 @@ class Channel:
     A class for modeling channels.
     """
 
+    # Keeps the latest channel under the 'latest' key, it is requested on almost every update.
+    cache = TTLCache(CHANNEL_CACHE_TTL)
+
+    def add_channel(self, username: str, date_added: str):
+        """
+        Saves a new channel to the database, which becomes the latest channel.
+        """
+
+        sk = Storekeeper()
+
+        try:
+            sk.get_supplies('channels', ['username', 'date_added'], [username, date_added])
+        finally:
+            Channel.cache.invalidate()
+
+
     def get_channel(self, link: str = None, latest: bool = True) -> dict:
         """
         Retrieves the data about the channel with the primary key and returns a dictionary containing the data.
+
+        The latest channel is served from the in-process cache for up to CHANNEL_CACHE_TTL seconds.
         """
 
         db = DB()
 
         result = None
         if not link and latest is True:
-            connection = db.make_connection()
-            cursor: msdb.cursors.Cursor = connection.cursor()
-            cursor.execute(
-                """SELECT * FROM channels ORDER BY date_added DESC LIMIT 1"""
-            )
-            result = cursor.fetchone()
+            cached = Channel.cache.get('latest', default=False)
+            if cached is not False:
+                return cached
+            generation = Channel.cache.generation
+            with db.get_cursor() as cursor:
+                cursor.execute(
+                    """SELECT * FROM channels ORDER BY date_added DESC LIMIT 1"""
+                )
+                result = cursor.fetchone()
         elif link and latest is False:
-            connection = db.make_connection()
-            cursor: msdb.cursors.Cursor = connection.cursor()
-            cursor.execute(
-                """SELECT * FROM channels WHERE username = '%s'""" % link
-            )
-            result = cursor.fetchone()
+            with db.get_cursor() as cursor:
+                cursor.execute(
+                    """SELECT * FROM channels WHERE username = %s""", (link,)
+                )
+                result = cursor.fetchone()
         else:
             raise ValueError(
                 'You cannot pass LINK and set LATEST to True simultaneously! Pass LINK or set latest to True!'
             )
-        db.close_connection(connection, cursor)
+        resulting_dict = None
         if result:
             resulting_dict = {
                 'username': result[0],
                 'date_added': result[1],
             }
-            return resulting_dict
-        return None
+        if latest is True:
+            Channel.cache.set('latest', resulting_dict, generation=generation)
+        return resulting_dict
 
 
     def get_channel_usernames(self) -> tuple:
@@ -88,11 +632,9 @@ class Channel:
 
         db = DB()
 
-        connection = db.make_connection()
-        cursor: msdb.cursors.Cursor = connection.cursor()
-        cursor.execute("""SELECT username FROM channels""")
-        results = cursor.fetchall()
-        db.close_connection(connection, cursor)
+        with db.get_cursor() as cursor:
+            cursor.execute("""SELECT username FROM channels""")
+            results = cursor.fetchall()
         return [each[0] for each in results] if results else None
 
 
@@ -101,6 +643,63 @@ class DBFactory:
     A class for creating tables and modifying them.
     """
 
+    def add_column(self, table_name: str, field: str, after: str = None) -> str:
+        """
+        Creates a statement that adds a column to an existing table.
+
+        :param: table_name: Accepts a string type of the name for the table.
+        :param: field: Accepts a field definition, e.g. the result of the charfield or integerfield methods.
+        :param: after: Defaults to None, accepts the name of the column after which the new one is placed.
+        :returns: A string containing an SQL statement to alter the table in the database.
+        """
+
+        statement = "ALTER TABLE %s ADD COLUMN %s" % (check_identifier(table_name), field)
+        return statement if not after else "%s AFTER %s" % (statement, check_identifier(after))
+
+
+    def add_index(self, table_name: str, index_name: str, columns: str | list | tuple, unique: bool = False) -> str:
+        """
+        Creates a statement that adds a secondary index to an existing table.
+
+        :param: table_name: Accepts a string type of the name for the table.
+        :param: index_name: Accepts a string type of the name for the index.
+        :param: columns: Accepts a column name or a list of column names, in the order they are indexed.
+        :param: unique: If true UNIQUE index is created.
+        :returns: A string containing an SQL statement to alter the table in the database.
+        """
+
+        columns = [columns] if isinstance(columns, str) else columns
+        index_definition = {
+            'table_name': check_identifier(table_name),
+            'index_type': 'UNIQUE INDEX' if unique else 'INDEX',
+            'index_name': check_identifier(index_name),
+            'columns': ', '.join([check_identifier(column) for column in columns]),
+        }
+        return "ALTER TABLE %(table_name)s ADD %(index_type)s %(index_name)s (%(columns)s)" % index_definition
+
+
+    def autofield(self, field_name: str) -> str:
+        """
+        Creates an auto incremented integer field, which is the primary key of the table.
+
+        :param: field_name: Accepts a string type of the name for the column.
+        :returns: A string containing an SQL statement to create a field in the database.
+        """
+
+        return "%s INT NOT NULL AUTO_INCREMENT PRIMARY KEY" % field_name
+
+
+    def blobfield(self, field_name: str) -> str:
+        """
+        Creates a binary field, which holds up to 64 kilobytes.
+
+        :param: field_name: Accepts a string type of the name for the column.
+        :returns: A string containing an SQL statement to create a field in the database.
+        """
+
+        return "%s BLOB" % field_name
+
+
     def charfield(self, field_name: str, max_length: int, long_text: bool = False, default: str = None) -> str:
         """
         Creates a character field, which is ideally for short text.
@@ -122,22 +721,22 @@ class DBFactory:
             return "%s VARCHAR(%d)" % without_default if not default else "%s VARCHAR(%d) DEFAULT '%s'" % with_default
     
 
-    def create_table(self, table_name, *args):
+    def create_table(self, table_name, *args, if_not_exists: bool = False):
         """
         Creates a table with the specified name.
+
+        Set if_not_exists to True to leave an already existing table as it is instead of raising an error.
         """
         
         db = DB()
 
-        connection = db.make_connection()
-        cursor: msdb.cursors.Cursor = connection.cursor()
         table_definition = {
-            'table_name': table_name,
+            'if_not_exists': 'IF NOT EXISTS ' if if_not_exists else '',
+            'table_name': check_identifier(table_name),
             'columns': ', '.join([arg for arg in args])
         }
-        cursor.execute("""CREATE TABLE %(table_name)s (%(columns)s)""" % table_definition)
-        connection.commit()
-        db.close_connection(connection, cursor)
+        with db.get_cursor() as cursor:
+            cursor.execute("""CREATE TABLE %(if_not_exists)s%(table_name)s (%(columns)s)""" % table_definition)
     
 
     def set_constraint(self, constraint_name: str, for_column: str, constraint_type: str = 'PRIMARY KEY'):
@@ -167,10 +766,22 @@ class DBFactory:
         return "%s DATETIME" % field_name if not date_only else "%s DATE" % field_name
 
 
+    def drop_index(self, table_name: str, index_name: str) -> str:
+        """
+        Creates a statement that drops a secondary index of an existing table.
+
+        :param: table_name: Accepts a string type of the name for the table.
+        :param: index_name: Accepts a string type of the name for the index.
+        :returns: A string containing an SQL statement to alter the table in the database.
+        """
+
+        return "ALTER TABLE %s DROP INDEX %s" % (check_identifier(table_name), check_identifier(index_name))
+
+
     def integerfield(self, 
                      field_name: str, 
                      int_type: str = 'integer',
-                     default: int = 0) -> str:
+                     default: int | None = 0) -> str:
         """
         Creates an integer field.
 
@@ -181,23 +792,480 @@ class DBFactory:
             4. integer
             5. bigint
 
-        :param: field_name: Accepts a string type of the name for the column.
-        :param: default: Defaults to 0, accepts a default value for the field.
-        :returns: A string containing an SQL statement to create a field in the database.
+        :param: field_name: Accepts a string type of the name for the column.
+        :param: default: Defaults to 0, accepts a default value for the field. Pass None for a field that defaults to NULL.
+        :returns: A string containing an SQL statement to create a field in the database.
+        """
+
+        types = {
+            'tinyint': 'TINYINT',
+            'smallint': 'SMALLINT',
+            'mediumint': 'MEDIUMINT',
+            'integer': 'INT',
+            'bigint': 'BIGINT',
+        }
+        if int_type.lower() in types:
+            if default is None:
+                return "%s %s" % (field_name, types[int_type.lower()])
+            return "%s %s DEFAULT %d" % (field_name, types[int_type.lower()], default)
+        else:
+            raise TypeError("Invalid integer type! Please check out the description of the integerfield method.")
+
+
+    def modify_column(self, table_name: str, field: str) -> str:
+        """
+        Creates a statement that changes the definition of an existing column.
+
+        :param: table_name: Accepts a string type of the name for the table.
+        :param: field: Accepts the new field definition, e.g. the result of the charfield or blobfield methods.
+        :returns: A string containing an SQL statement to alter the table in the database.
+        """
+
+        return "ALTER TABLE %s MODIFY COLUMN %s" % (check_identifier(table_name), field)
+
+
+class Migrator:
+    """
+    A class for applying versioned schema changes (migrations) to the database.
+
+    Every migration is a dictionary with the following keys:
+        1. version - a positive integer, migrations are applied in ascending order of it.
+        2. description - a short text that is saved along with the version.
+        3. statements - a list of SQL statements, ideally built with the DBFactory methods.
+    Applied versions are recorded in the schema_version table, so every migration runs only once.
+    """
+
+    # MySQL errors of statements that have already been applied: duplicate column, duplicate key name 
+    # and dropping a column or key that does not exist. They are skipped so that a migration 
+    # interrupted halfway (DDL cannot be rolled back) can be run again.
+    already_applied_errors = (1060, 1061, 1091)
+
+    def __init__(self, migrations: list | tuple):
+        versions = [migration['version'] for migration in migrations]
+        if len(set(versions)) != len(versions):
+            raise ValueError('Every migration should have a unique version!')
+        self.migrations = sorted(migrations, key=lambda migration: migration['version'])
+
+
+    def create_version_table(self):
+        """
+        Creates the schema_version table if it does not exist.
+        """
+
+        fac = DBFactory()
+
+        fac.create_table(
+            'schema_version',
+            fac.integerfield('version'),
+            fac.charfield('description', 300, long_text=True),
+            fac.datetimefield('date_applied'),
+            fac.set_constraint('pk_schema_version', 'version'),
+            if_not_exists=True,
+        )
+
+
+    def get_schema_version(self) -> int:
+        """
+        Returns the version of the latest applied migration, 0 if none has been applied.
+
+        The schema_version table is created on the first call, when it does not exist yet.
+        """
+
+        db = DB()
+
+        try:
+            with db.get_cursor() as cursor:
+                cursor.execute("""SELECT MAX(version) FROM schema_version""")
+                result = cursor.fetchone()
+        except ProgrammingError as e:
+            # 1146 - table does not exist.
+            if e.args[0] != 1146:
+                raise
+            self.create_version_table()
+            return 0
+        return int(result[0]) if result and result[0] is not None else 0
+
+
+    def migrate(self) -> list:
+        """
+        Applies the migrations that have not been applied yet and returns the list of applied versions.
+        """
+
+        db = DB()
+
+        current_version = self.get_schema_version()
+        applied = []
+        for migration in self.migrations:
+            if migration['version'] <= current_version:
+                continue
+            with db.get_cursor() as cursor:
+                for statement in migration['statements']:
+                    try:
+                        cursor.execute(statement)
+                    except OperationalError as e:
+                        if e.args[0] not in self.already_applied_errors:
+                            raise
+                        print('Skipping an already applied statement: ', statement)
+                cursor.execute(
+                    """INSERT INTO schema_version (version, description, date_applied) VALUES (%s, %s, %s)""",
+                    (
+                        migration['version'],
+                        migration['description'],
+                        time.strftime(r"%Y-%m-%d %H:%M:%S", time.localtime()),
+                    ),
+                )
+            print('Migration %d applied: %s' % (migration['version'], migration['description']))
+            applied.append(migration['version'])
+        return applied
+
+
+class Notification:
+    """
+    A class for modeling the messages saved in the outbox, see Outbox.
+    """
+
+    # Values of the status column.
+    PENDING = 0
+    DELIVERED = 1
+    FAILED = 2
+
+    def add_notifications(self, messages: list | tuple) -> list:
+        """
+        Saves the messages as pending in a single transaction and returns their ids in the same order.
+
+        The rows are inserted in bulk - see Storekeeper.get_supplies_in_bulk - and tagged with a random key 
+        of the batch, by which their ids are read back with a single query.
+        :param: messages: Accepts a list of dictionaries with chat_id and text keys, and optionally 
+        parse_mode and reply_markup - a JSON string.
+        """
+
+        db = DB()
+        sk = Storekeeper()
+
+        batch_key = random_word(32)
+        date_created = time.strftime(r"%Y-%m-%d %H:%M:%S", time.localtime())
+        sk.get_supplies_in_bulk(
+            'notifications',
+            ['chat_id', 'text', 'parse_mode', 'reply_markup', 'status', 'date_created', 'batch_key'],
+            [
+                (
+                    message['chat_id'],
+                    message['text'],
+                    message.get('parse_mode'),
+                    message.get('reply_markup'),
+                    self.PENDING,
+                    date_created,
+                    batch_key,
+                )
+                for message in messages
+            ],
+        )
+        with db.get_cursor() as cursor:
+            # The ids of a multi-row INSERT are assigned in the order of its rows.
+            cursor.execute(
+                """SELECT notification_id FROM notifications WHERE batch_key = %s ORDER BY notification_id""",
+                (batch_key,),
+            )
+            results = cursor.fetchall()
+        return [result[0] for result in results]
+
+
+    def delete_sent_notifications(self, sent_before: str, limit: int) -> int:
+        """
+        Deletes at most LIMIT delivered or failed messages that were sent before the given time.
+
+        :param: sent_before: Accepts a string of the time in the %Y-%m-%d %H:%M:%S format.
+        :returns: The number of deleted messages.
+        """
+
+        db = DB()
+
+        with db.get_cursor() as cursor:
+            cursor.execute(
+                """DELETE FROM notifications WHERE status IN (%s, %s) AND date_sent < %s LIMIT %s""",
+                (self.DELIVERED, self.FAILED, sent_before, limit),
+            )
+            return cursor.rowcount
+
+
+    def get_pending_notifications(self, limit: int) -> list:
+        """
+        Retrieves at most LIMIT pending messages, the oldest ones first.
+        """
+
+        db = DB()
+
+        with db.get_cursor() as cursor:
+            cursor.execute(
+                """SELECT notification_id, chat_id, text, parse_mode, reply_markup FROM notifications """ \
+                """WHERE status = %s ORDER BY notification_id LIMIT %s""",
+                (self.PENDING, limit),
+            )
+            results = cursor.fetchall()
+        return [
+            {
+                'notification_id': result[0],
+                'chat_id': result[1],
+                'text': result[2],
+                'parse_mode': result[3],
+                'reply_markup': result[4],
+            }
+            for result in results
+        ]
+
+
+    def mark_notification(self, notification_id: int, status: int):
+        """
+        Sets the status of the message, along with the time it was sent.
+        """
+
+        db = DB()
+
+        with db.get_cursor() as cursor:
+            cursor.execute(
+                """UPDATE notifications SET status = %s, date_sent = %s WHERE notification_id = %s""",
+                (status, time.strftime(r"%Y-%m-%d %H:%M:%S", time.localtime()), notification_id),
+            )
+
+
+class Outbox:
+    """
+    A class for sending messages through the notifications table, so that they are not lost when the bot restarts.
+
+    Messages are saved as pending first and then sent by the worker - see run - in batches of BATCH_SIZE.
+    Every message is marked as delivered or failed as soon as it has been sent, so after a restart 
+    the worker continues with the messages that are still pending and does not send the others again.
+    The worker deletes the messages that were sent more than KEEP_SENT seconds ago every PURGE_INTERVAL seconds.
+    Only one worker should run at a time.
+    """
+
+    def __init__(
+            self,
+            sender: 'Sender',
+            batch_size: int = OUTBOX_BATCH_SIZE,
+            poll_interval: int | float = OUTBOX_POLL_INTERVAL,
+            deliver_timeout: int | float = OUTBOX_DELIVER_TIMEOUT,
+            keep_sent: int | float = OUTBOX_KEEP_SENT,
+            purge_interval: int | float = OUTBOX_PURGE_INTERVAL,
+    ):
+        self.sender = sender
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.deliver_timeout = deliver_timeout
+        self.keep_sent = keep_sent
+        self.purge_interval = purge_interval
+        # time.monotonic() of the last purge, see _purge_sent.
+        self._purged_at = None
+        self.model = AsyncModel(Notification())
+        self._wake_up = asyncio.Event()
+        # notification id -> future that is resolved with True or False once the message has been sent.
+        self._waiters = {}
+        # notification id -> status of the messages that have been sent, but could not be marked yet. 
+        # They are not sent again, only the marking is retried, see _mark_unmarked.
+        self._unmarked = {}
+
+
+    async def deliver(self, chunks) -> dict:
+        """
+        Saves the messages to the outbox chunk by chunk and waits at most DELIVER_TIMEOUT seconds 
+        after the last chunk until the worker sends them.
+
+        Every chunk is saved as soon as it comes, so the worker starts sending before all of them are saved 
+        and only the chunk at hand is kept in memory.
+        :param: chunks: Accepts an async iterable of lists of messages, see Notification.add_notifications.
+        :returns: A dictionary containing the numbers of delivered, failed and still pending messages.
+        """
+
+        loop = asyncio.get_running_loop()
+        # notification id -> the future of the message, the same one as in _waiters.
+        futures = {}
+        async for messages in chunks:
+            if not messages:
+                continue
+            for notification_id in await self.model.add_notifications(messages):
+                futures[notification_id] = self._waiters[notification_id] = loop.create_future()
+            self._wake_up.set()
+        if not futures:
+            return {'delivered': 0, 'failed': 0, 'pending': 0}
+        done, pending = await asyncio.wait(futures.values(), timeout=self.deliver_timeout)
+        for notification_id, future in futures.items():
+            # The messages left pending are still sent by the worker, just nobody waits for them.
+            if not future.done():
+                self._waiters.pop(notification_id, None)
+        delivered = sum(1 for future in done if future.result() is True)
+        return {'delivered': delivered, 'failed': len(done) - delivered, 'pending': len(pending)}
+
+
+    async def put(self, messages: list | tuple) -> list:
+        """
+        Saves the messages to the outbox and returns their ids without waiting for them to be sent.
+
+        :param: messages: See Notification.add_notifications.
+        """
+
+        if not messages:
+            return []
+        notification_ids = await self.model.add_notifications(messages)
+        self._wake_up.set()
+        return notification_ids
+
+
+    async def run(self):
+        """
+        Sends the pending messages until cancelled.
+
+        When there are no pending messages, waits until new ones are put or POLL_INTERVAL seconds pass.
+        """
+
+        while True:
+            # Cleared before reading, so that the messages put in the meantime wake the worker up again.
+            self._wake_up.clear()
+            if self._purged_at is None or time.monotonic() - self._purged_at >= self.purge_interval:
+                await self._purge_sent()
+            try:
+                await self._mark_unmarked()
+                notifications = [
+                    notification 
+                    for notification in await self.model.get_pending_notifications(self.batch_size)
+                    if notification['notification_id'] not in self._unmarked
+                ]
+                if notifications:
+                    await asyncio.gather(*[self._send(notification) for notification in notifications])
+                    continue
+            except Exception as e:
+                # The worker is never left to die, otherwise nothing would be sent until the bot restarts.
+                print('Outbox could not read the notifications: ', e)
+            try:
+                await asyncio.wait_for(self._wake_up.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+    async def _purge_sent(self):
+        """
+        Deletes the delivered and failed messages that were sent more than KEEP_SENT seconds ago, BATCH_SIZE at a time.
+        """
+
+        # Set beforehand, so that a failed purge is retried only at the next interval.
+        self._purged_at = time.monotonic()
+        sent_before = time.strftime(r"%Y-%m-%d %H:%M:%S", time.localtime(time.time() - self.keep_sent))
+        try:
+            while await self.model.delete_sent_notifications(sent_before, self.batch_size) == self.batch_size:
+                pass
+        except Exception as e:
+            print('Outbox could not delete the sent notifications: ', e)
+
+
+    async def _send(self, notification: dict):
+        """
+        Sends a single message, saves the outcome and resolves the future of the one who is waiting for it.
+        """
+
+        notification_id = notification['notification_id']
+        kwargs = {
+            key: notification[key] for key in ('parse_mode', 'reply_markup') if notification[key] is not None
+        }
+        delivered = False
+        try:
+            delivered = await self.sender.send(notification['chat_id'], notification['text'], **kwargs)
+        except Exception as e:
+            print('Message %s of the outbox could not be sent: ' % notification_id, e)
+        try:
+            status = Notification.DELIVERED if delivered else Notification.FAILED
+            try:
+                await self.model.mark_notification(notification_id, status)
+            except Exception as e:
+                print('Message %s of the outbox could not be marked, retrying later: ' % notification_id, e)
+                self._unmarked[notification_id] = status
+        finally:
+            waiter = self._waiters.pop(notification_id, None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(delivered)
+
+
+    async def _mark_unmarked(self):
+        """
+        Retries marking the messages that have been sent, but could not be marked, see _send.
+        """
+
+        for notification_id, status in list(self._unmarked.items()):
+            await self.model.mark_notification(notification_id, status)
+            del self._unmarked[notification_id]
+
+
+class Sender:
+    """
+    A class for sending many messages concurrently without exceeding the Telegram rate limits.
+
+    Keeps at most CONCURRENCY messages in flight, RATE messages per second in total and one message per 
+    CHAT_INTERVAL seconds to the same chat. Messages that fail with RetryAfter or a network error are retried 
+    with backoff, the other errors (blocked bot, deleted chat, bad request...) are not retried.
+    One sender should be shared by the whole bot, so that all the broadcasts count towards the same limits.
+    """
+
+    def __init__(
+            self,
+            bot,
+            rate: int | float = SENDER_RATE,
+            chat_interval: int | float = SENDER_CHAT_INTERVAL,
+            concurrency: int = SENDER_CONCURRENCY,
+            max_retries: int = SENDER_MAX_RETRIES,
+    ):
+        self.bot = bot
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # Loop times at which the next message may be sent, in total and to every chat.
+        self._next_slot = 0
+        self._next_chat_slots = {}
+
+
+    async def send(self, chat_id: int | str, text: str, **kwargs) -> bool:
         """
+        Sends the message and returns True if it was delivered, otherwise False.
 
-        if int_type.lower() == 'tinyint':
-            return "%s TINYINT DEFAULT %d" % (field_name, default)
-        elif int_type.lower() == 'smallint':
-            return "%s SMALLINT DEFAULT %d" % (field_name, default)
-        elif int_type.lower() == 'mediumint':
-            return "%s MEDIUMINT DEFAULT %d" % (field_name, default)
-        elif int_type.lower() == 'integer':
-            return "%s INT DEFAULT %d" % (field_name, default)
-        elif int_type.lower() == 'bigint':
-            return "%s BIGINT DEFAULT %d" % (field_name, default)
-        else:
-            raise TypeError("Invalid integer type! Please check out the description of the integerfield method.")
+        The keyword arguments are passed to bot.send_message.
+        """
+
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self._wait_for_slot(chat_id)
+                try:
+                    await self.bot.send_message(chat_id, text, **kwargs)
+                except RetryAfter as e:
+                    # Flood control applies to the whole bot, so every other message waits as well.
+                    self._next_slot = max(self._next_slot, asyncio.get_running_loop().time() + e.timeout)
+                except (NetworkError, asyncio.TimeoutError):
+                    await asyncio.sleep(2 ** attempt)
+                except TelegramAPIError as e:
+                    print('Message to %s was not delivered: ' % chat_id, e)
+                    return False
+                else:
+                    return True
+            print('Message to %s was not delivered after %d retries.' % (chat_id, self.max_retries))
+            return False
+
+
+    async def _wait_for_slot(self, chat_id: int | str):
+        """
+        Sleeps until the message may be sent to the chat without exceeding the limits.
+        """
+
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        chat_slot = max(now, self._next_chat_slots.get(chat_id, 0))
+        self._next_chat_slots[chat_id] = chat_slot + self.chat_interval
+        if len(self._next_chat_slots) > 10000:
+            self._next_chat_slots = {
+                chat: slot for chat, slot in self._next_chat_slots.items() if slot > now
+            }
+        await asyncio.sleep(chat_slot - now)
+
+        now = loop.time()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + 1 / self.rate
+        await asyncio.sleep(slot - now)
 
 
 class Storekeeper:
@@ -212,14 +1280,11 @@ class Storekeeper:
         
         db = DB()
         
-        connection = db.make_connection()
-        cursor: msdb.cursors.Cursor = connection.cursor()
         try:
-            cursor.execute("""DROP TABLE %s""" % table_name)
+            with db.get_cursor() as cursor:
+                cursor.execute("""DROP TABLE %s""" % check_identifier(table_name))
         except OperationalError:
             raise ValueError("Invalid table name!")
-        finally:
-            db.close_connection(connection, cursor)
     
 
     def get_supplies(self, table_name: str, columns: list | tuple, values: list | tuple):
@@ -232,24 +1297,66 @@ class Storekeeper:
         db = DB()
         
         if len(columns) == len(values):
-            columns = ["{}".format(column) for column in columns]
-            values = ["'{}'".format(value) for value in values]
-            columns = ', '.join(columns)
-            values = ', '.join(values)
             entries = {
-                'table_name': table_name,
-                'columns': columns,
-                'values': values,
+                'table_name': check_identifier(table_name),
+                'columns': ', '.join([check_identifier(column) for column in columns]),
+                'placeholders': ', '.join(['%s'] * len(values)),
             }
-            connection = db.make_connection()
-            cursor: msdb.cursors.Cursor = connection.cursor()
-            cursor.execute("""INSERT INTO %(table_name)s (%(columns)s) VALUES (%(values)s)""" % entries)
-            connection.commit()
-            db.close_connection(connection, cursor)
+            with db.get_cursor() as cursor:
+                cursor.execute(
+                    """INSERT INTO %(table_name)s (%(columns)s) VALUES (%(placeholders)s)""" % entries,
+                    tuple(values),
+                )
         else:
             raise ValueError('Invalid number of columns and values! The length of the two does not correspond.')
     
 
+    def get_supplies_in_bulk(
+            self, 
+            table_name: str, 
+            columns: list | tuple, 
+            rows: list | tuple, 
+            chunk_size: int = BULK_INSERT_CHUNK_SIZE,
+    ) -> int:
+        """
+        Inserts many rows into the given columns of the given table and returns the number of inserted rows.
+
+        Rows are sent as multi-row INSERT statements of at most CHUNK_SIZE rows each, all of them 
+        in a single transaction: either every row is inserted or, if any chunk fails, none of them.
+
+        NOTE: the length of every row should correspond to the length of columns, otherwise ValueError is raised.
+        """
+
+        db = DB()
+
+        if chunk_size < 1:
+            raise ValueError('CHUNK_SIZE should be at least 1!')
+        rows = [tuple(row) for row in rows]
+        if any(len(row) != len(columns) for row in rows):
+            raise ValueError('Invalid number of columns and values! The length of the two does not correspond.')
+        if not rows:
+            return 0
+        entries = {
+            'table_name': check_identifier(table_name),
+            'columns': ', '.join([check_identifier(column) for column in columns]),
+            'placeholders': ', '.join(['%s'] * len(columns)),
+        }
+        query = """INSERT INTO %(table_name)s (%(columns)s) VALUES (%(placeholders)s)""" % entries
+        inserted = 0
+        with db.get_cursor() as cursor:
+            connection: Connection = cursor.connection
+            connection.begin()
+            try:
+                for start in range(0, len(rows), chunk_size):
+                    inserted += cursor.executemany(query, rows[start:start + chunk_size])
+            except BaseException:
+                connection.rollback()
+                raise
+            else:
+                connection.commit()
+        return inserted
+    
+
     def table_exists(self, table_name: str) -> bool:
         """
         Checks if the given table exists in the database.
@@ -257,14 +1364,35 @@ class Storekeeper:
         
         db = DB()
 
-        connection = db.make_connection()
-        cursor: msdb.cursors.Cursor = connection.cursor()
-        cursor.execute("""SHOW TABLES LIKE '%s'""" % table_name)
-        result = cursor.fetchone()
-        db.close_connection(connection, cursor)
+        with db.get_cursor() as cursor:
+            cursor.execute("""SHOW TABLES LIKE %s""", (table_name,))
+            result = cursor.fetchone()
         return True if result else False
     
 
+    def tables_exist(self, *table_names: str) -> dict:
+        """
+        Checks which of the given tables exist in the database with a single query.
+
+        :returns: A dictionary containing {table_name: True or False} pairs for every given table.
+        """
+
+        db = DB()
+
+        if not table_names:
+            return {}
+        placeholders = ', '.join(['%s'] * len(table_names))
+        with db.get_cursor() as cursor:
+            cursor.execute(
+                """SELECT table_name FROM information_schema.tables """ \
+                """WHERE table_schema = DATABASE() AND table_name IN (%s)""" % placeholders,
+                table_names,
+            )
+            results = cursor.fetchall()
+        existing = {str(result[0]).lower() for result in results}
+        return {table_name: table_name.lower() in existing for table_name in table_names}
+    
+
     def throw_item_away(self, table_name: str, pk_name: str, pk_value: str | int):
         """
         Deletes an item corresponding to the given primary key from a row in the given table.
@@ -272,11 +1400,11 @@ class Storekeeper:
         
         db = DB()
         
-        connection = db.make_connection()
-        cursor: msdb.cursors.Cursor = connection.cursor()
-        cursor.execute("""DELETE FROM {} WHERE {} = '{}';""".format(table_name, pk_name, pk_value))
-        connection.commit()
-        db.close_connection(connection, cursor)
+        with db.get_cursor() as cursor:
+            cursor.execute(
+                """DELETE FROM {} WHERE {} = %s""".format(check_identifier(table_name), check_identifier(pk_name)),
+                (pk_value,),
+            )
 
 
 class Test:
@@ -284,6 +1412,78 @@ class Test:
     A class for modeling tests.
     """
 
+    # test_id -> the test dictionary of an active test, along with its parsed answer key. 
+    # Filled by add_test and get_test, entries are dropped when the test is deactivated.
+    registry = LRUCache(TEST_REGISTRY_SIZE)
+    # Bumped by every change of the tests, see VersionCounter.
+    data_version = VersionCounter()
+
+    def add_test(self, test_id: int, test_subject: str, creator: str, answers: str, date_created: str):
+        """
+        Saves a new test to the database and registers it as an active test.
+
+        :param: answers: Accepts the answers separated by comma, they are saved packed - one byte per answer.
+        """
+
+        sk = Storekeeper()
+
+        sk.get_supplies(
+            'tests',
+            ['test_id', 'test_subject', 'creator', 'answers', 'date_created'],
+            [test_id, test_subject, creator, encode_answers(answers), date_created],
+        )
+        Test.registry.set(
+            int(test_id),
+            self._with_answer_key({
+                'test_id': int(test_id),
+                'test_subject': test_subject,
+                'creator': creator,
+                'answers': answers,
+                'start_date': date_created,
+                'end_date': None,
+                'is_active': True,
+            }),
+        )
+        Test.data_version.bump()
+
+
+    def allocate_test_id(self) -> int:
+        """
+        Hands out a test id that no test has, without reading the ids of the existing tests.
+
+        Every call takes the next number of the test_id sequence with an atomic increment, so concurrent calls 
+        never get the same number, and maps it to an id of the range with a keyed permutation, see TEST_ID_MIN.
+        The ids given to tests before the sequence existed are skipped.
+
+        NOTE: ValueError is raised when every id of the range has been handed out.
+        """
+
+        db = DB()
+
+        capacity = TEST_ID_MAX - TEST_ID_MIN + 1
+        if math.gcd(TEST_ID_MULTIPLIER, capacity) != 1:
+            raise ValueError('TEST_ID_MULTIPLIER should have no common divisor with the size of the test id range!')
+        while True:
+            with db.get_cursor() as cursor:
+                updated = cursor.execute(
+                    """UPDATE sequences SET next_value = LAST_INSERT_ID(next_value + 1) WHERE sequence_name = %s""",
+                    ('test_id',),
+                )
+                if not updated:
+                    cursor.execute(
+                        """INSERT IGNORE INTO sequences (sequence_name, next_value) VALUES (%s, 0)""", ('test_id',)
+                    )
+                    continue
+                # LAST_INSERT_ID is kept per connection, so it is the value set by this very statement.
+                number = cursor.lastrowid - 1
+                if number >= capacity:
+                    raise ValueError('All the test ids are in use!')
+                test_id = TEST_ID_MIN + (number * TEST_ID_MULTIPLIER + TEST_ID_OFFSET) % capacity
+                cursor.execute("""SELECT 1 FROM tests WHERE test_id = %s""", (test_id,))
+                if cursor.fetchone() is None:
+                    return test_id
+
+
     def deactivate(self, test_id: str):
         """
         Sets the is_active attribute of a test to 0(False).
@@ -294,51 +1494,43 @@ class Test:
         test = self.get_test(test_id)
         if test is not None:
             if int(test['is_active']) == True:
-                connection = db.make_connection()
-                cursor: msdb.cursors.Cursor = connection.cursor()
                 now = time.strftime(r"%Y-%m-%d %H:%M:%S", time.localtime())
-                cursor.execute(
-                    """UPDATE tests SET is_active = 0, date_deactivated = '%s' WHERE test_id = '%s'""" % \
-                    (now, test_id)
-                )
-                connection.commit()
-                db.close_connection(connection, cursor)
+                with db.get_cursor() as cursor:
+                    deactivated = cursor.execute(
+                        """UPDATE tests SET is_active = 0, date_deactivated = %s WHERE test_id = %s AND is_active = 1""",
+                        (now, test_id),
+                    )
+                Test.registry.invalidate(int(test_id))
+                TestResult.leaderboards.invalidate(int(test_id))
+                Test.data_version.bump()
+                if not deactivated:
+                    raise AttributeError('The test is already deactivated!')
             else:
                 raise AttributeError('The test is already deactivated!')
         else:
             raise ValueError('Test with the given id does not exist!')
     
 
-    def get_all_test_ids(self) -> list:
-        """
-        Retrieves all the ids related to test from the the database.
-        """
-        
-        db = DB()
-
-        connection = db.make_connection()
-        cursor: msdb.cursors.Cursor = connection.cursor()
-        cursor.execute("""SELECT test_id FROM tests""")
-        results = cursor.fetchall()
-        db.close_connection(connection, cursor)
-        return list(results) if results else None
-    
-
     def get_test(self, test_id: str) -> dict:
         """
         Retrieves the data about the test with the primary key and returns a dictionary containing the data.
+
+        Along with the columns, the dictionary contains the answer_key - the correct answers as a byte string.
+        Active tests are served from the in-process registry when possible.
         """
 
         db = DB()
 
         if test_id:
-            connection = db.make_connection()
-            cursor: msdb.cursors.Cursor = connection.cursor()
-            cursor.execute("""SELECT * FROM tests WHERE test_id = '%s'""" % test_id)
-            result = cursor.fetchone()
-            db.close_connection(connection, cursor)
+            cached = Test.registry.get(int(test_id))
+            if cached is not None:
+                return dict(cached)
+            generation = Test.registry.generation
+            with db.get_cursor() as cursor:
+                cursor.execute("""SELECT * FROM tests WHERE test_id = %s""", (test_id,))
+                result = cursor.fetchone()
             if result:
-                resulting_dict = {
+                resulting_dict = self._with_answer_key({
                     'test_id': result[0],
                     'test_subject': result[1],
                     'creator': result[2],
@@ -346,38 +1538,80 @@ class Test:
                     'start_date': result[4],
                     'end_date': result[5],
                     'is_active': True if int(result[6]) == 1 else False,
-                }
-                return resulting_dict
+                })
+                if resulting_dict['is_active'] is True:
+                    Test.registry.set(int(test_id), resulting_dict, generation=generation)
+                return dict(resulting_dict)
         return None
     
 
+    def get_test_id_usage(self) -> dict:
+        """
+        Tells how much of the test id range is taken by the tests, including the ones added before allocate_test_id.
+
+        The ids are counted over the range of the primary key, no rows are read.
+        :returns: A dictionary containing the number of used ids, the capacity of the range and the used percent.
+        """
+
+        db = DB()
+
+        with db.get_cursor() as cursor:
+            cursor.execute(
+                """SELECT COUNT(*) FROM tests WHERE test_id BETWEEN %s AND %s""", (TEST_ID_MIN, TEST_ID_MAX)
+            )
+            result = cursor.fetchone()
+        capacity = TEST_ID_MAX - TEST_ID_MIN + 1
+        used = int(result[0])
+        return {'used': used, 'capacity': capacity, 'percent': get_percent(used, capacity)}
+
+
     def get_tests(self) -> list:
         """
         Retrieves all the tests from the database.
         """
         
+        output = list(self.iter_tests())
+        return output if output else None
+
+
+    def iter_tests(self, chunk_size: int = FETCH_CHUNK_SIZE):
+        """
+        Yields all the tests from the database one by one, fetching CHUNK_SIZE rows at a time 
+        through a server-side cursor, so only one chunk is kept in memory.
+
+        The connection is held until the generator is exhausted or closed.
+        """
+
         db = DB()
 
-        connection = db.make_connection()
-        cursor: msdb.cursors.Cursor = connection.cursor()
-        cursor.execute("""SELECT * FROM tests""")
-        results = cursor.fetchall()
-        db.close_connection(connection, cursor)
-        output = []
-        if results:
-            for result in results:
-                out_dict = {
-                    'test_id': result[0],
-                    'test_subject': result[1],
-                    'creator': result[2],
-                    'answers': result[3],
-                    'date_created': result[4],
-                    'date_deactivated': result[5],
-                    'is_active': True if int(result[6]) == 1 else False,
-                }
-                output.append(out_dict)
-            return output
-        return None 
+        with db.get_cursor(unbuffered=True) as cursor:
+            cursor.execute("""SELECT * FROM tests""")
+            while True:
+                results = cursor.fetchmany(chunk_size)
+                if not results:
+                    break
+                for result in results:
+                    yield {
+                        'test_id': result[0],
+                        'test_subject': result[1],
+                        'creator': result[2],
+                        'answers': decode_answers(encode_answers(result[3])),
+                        'date_created': result[4],
+                        'date_deactivated': result[5],
+                        'is_active': True if int(result[6]) == 1 else False,
+                    }
+
+
+    def _with_answer_key(self, test: dict) -> dict:
+        """
+        Adds the answer_key - the correct answers encoded by scoring.encode_answers - to the test dictionary.
+
+        The answers column is packed (one byte per answer), it is unpacked to answers separated by comma.
+        """
+
+        test['answer_key'] = encode_answers(test['answers'])
+        test['answers'] = decode_answers(test['answer_key'])
+        return test
 
 
 class TestResult:
@@ -385,33 +1619,260 @@ class TestResult:
     A class for modeling test results.
     """
 
-    def get_results(self, test_id: str) -> list:
+    # test_id -> the number of results of the test, dropped whenever a result of the test is saved.
+    counts = LRUCache(TEST_REGISTRY_SIZE)
+    # test_id -> the Leaderboard of an active test, built from the database by get_leaderboard and 
+    # kept up to date by submit. Entries are dropped when the test is deactivated.
+    leaderboards = LRUCache(TEST_REGISTRY_SIZE)
+
+    def count_results(self, test_id: str) -> int:
         """
-        Retrieves the test results with corresponding test id or creator, or gets all in the database.
+        Returns the number of results of the test, served from the in-process cache when possible.
         """
 
         db = DB()
 
-        if test_id:
-            connection = db.make_connection()
-            cursor: msdb.cursors.Cursor = connection.cursor()
+        cached = TestResult.counts.get(int(test_id))
+        if cached is not None:
+            return cached
+        generation = TestResult.counts.generation
+        with db.get_cursor() as cursor:
+            cursor.execute("""SELECT COUNT(*) FROM test_results WHERE test_id = %s""", (test_id,))
+            result = cursor.fetchone()
+        count = int(result[0]) if result else 0
+        TestResult.counts.set(int(test_id), count, generation=generation)
+        return count
+
+
+    def get_leaderboard(self, test_id: str, questions_length: int) -> Leaderboard:
+        """
+        Returns the leaderboard of the test, building it from the saved results when it is not in memory.
+
+        Should be used for active tests only, the leaderboards of the others are not kept up to date.
+        """
+
+        db = DB()
+
+        leaderboard = TestResult.leaderboards.get(int(test_id))
+        if leaderboard is not None:
+            return leaderboard
+        generation = TestResult.leaderboards.generation
+        leaderboard = Leaderboard(questions_length)
+        with db.get_cursor(unbuffered=True) as cursor:
             cursor.execute(
-                """SELECT test_taker, correct_answers, user_answers  FROM test_results WHERE test_id = '%s' """ \
-                "ORDER BY correct_answers DESC" % test_id
+                """SELECT test_taker, correct_answers, taker_chat_id FROM test_results """ \
+                """WHERE test_id = %s ORDER BY result_id""",
+                (test_id,),
             )
-            results = cursor.fetchall()
-            db.close_connection(connection, cursor)
-            if results:
-                resulting = []
+            while True:
+                results = cursor.fetchmany(FETCH_CHUNK_SIZE)
+                if not results:
+                    break
                 for result in results:
-                    out_dict = {
+                    leaderboard.add(result[0], result[1], key=result[2])
+        TestResult.leaderboards.set(int(test_id), leaderboard, generation=generation)
+        return leaderboard
+
+
+    def get_question_stats(self, test_id: str, answer_key: bytes) -> list:
+        """
+        Retrieves the statistics of every question of the test from the question_stats table, 
+        which holds the number of takers who chose each letter, so the cost does not depend on the number of takers.
+
+        :param: answer_key: Accepts the correct answers encoded by scoring.encode_answers.
+        :returns: A list of dictionaries containing question_no, correct - the number of takers who answered 
+        the question correctly, count - the number of takers and chosen - {letter: number of takers} pairs.
+        """
+
+        db = DB()
+
+        with db.get_cursor() as cursor:
+            cursor.execute(
+                """SELECT question_no, letter, chosen_count FROM question_stats WHERE test_id = %s """ \
+                """ORDER BY question_no, letter""",
+                (test_id,),
+            )
+            results = cursor.fetchall()
+        stats = [
+            {'question_no': number, 'correct': 0, 'count': 0, 'chosen': {}} 
+            for number in range(1, len(answer_key) + 1)
+        ]
+        for question_no, letter, chosen_count in results:
+            if not 1 <= question_no <= len(answer_key):
+                continue
+            letter = letter.decode('ascii') if isinstance(letter, bytes) else str(letter)
+            question = stats[question_no - 1]
+            question['chosen'][letter] = int(chosen_count)
+            question['count'] += int(chosen_count)
+            if letter == chr(answer_key[question_no - 1]):
+                question['correct'] += int(chosen_count)
+        return stats
+
+
+    def get_rank(self, test_id: str, questions_length: int, correct_answers: int) -> dict:
+        """
+        Returns the rank of a taker of the active test with the given number of correct answers.
+
+        :returns: A dictionary containing the rank and the number of takers - count.
+        """
+
+        leaderboard = self.get_leaderboard(test_id, questions_length)
+        return {'rank': leaderboard.rank(correct_answers), 'count': len(leaderboard)}
+
+
+    def get_results_page(self, test_id: str, limit: int, offset: int = 0, questions_length: int = None) -> list:
+        """
+        Retrieves a page of the test results, the best ones first, along with the rank of every taker.
+
+        Takers with the same number of correct answers share the rank, the earlier result comes first among them.
+        Pass the number of questions of an active test to take the page from its leaderboard instead of the database.
+        :returns: A list of dictionaries containing rank, test_taker and correct_answers, empty past the last page.
+        """
+
+        db = DB()
+
+        if questions_length is not None:
+            return self.get_leaderboard(test_id, questions_length).page(offset, limit)
+        with db.get_cursor() as cursor:
+            cursor.execute(
+                """SELECT RANK() OVER (ORDER BY correct_answers DESC), test_taker, correct_answers """ \
+                """FROM test_results WHERE test_id = %s ORDER BY correct_answers DESC, result_id LIMIT %s OFFSET %s""",
+                (test_id, limit, offset),
+            )
+            results = cursor.fetchall()
+        return [
+            {
+                'rank': result[0],
+                'test_taker': result[1],
+                'correct_answers': result[2],
+            }
+            for result in results
+        ]
+
+
+    def iter_results_with_recipients(self, test_id: str, chunk_size: int = FETCH_CHUNK_SIZE):
+        """
+        Yields the results of the test along with the chat ids of the test takers in lists of at most CHUNK_SIZE,
+        fetching them through a server-side cursor, so only one chunk is kept in memory.
+
+        Takers who have been deleted from the users table are left out, since the results cannot be sent to them.
+        The connection is held until the generator is exhausted or closed, so every chunk should be handled quickly.
+        """
+
+        db = DB()
+
+        with db.get_cursor(unbuffered=True) as cursor:
+            cursor.execute(
+                """SELECT test_results.test_taker, users.chat_id, test_results.correct_answers, """ \
+                """test_results.user_answers FROM test_results """ \
+                """JOIN users ON users.chat_id = test_results.taker_chat_id """ \
+                """WHERE test_results.test_id = %s""",
+                (test_id,),
+            )
+            while True:
+                results = cursor.fetchmany(chunk_size)
+                if not results:
+                    break
+                yield [
+                    {
                         'test_taker': result[0],
-                        'correct_answers': result[1],
-                        'user_answers': result[2],
+                        'chat_id': result[1],
+                        'correct_answers': result[2],
+                        'user_answers': decode_answers(encode_answers(result[3])),
                     }
-                    resulting.append(out_dict)
-                return resulting
-            return None
+                    for result in results
+                ]
+
+
+    def submit(
+            self,
+            date_taken: str,
+            test_taker: str,
+            taker_chat_id: int,
+            test_id: int,
+            test_subject: str,
+            questions_length: int,
+            correct_answers: int,
+            incorrect_answers: int,
+            user_answers: str,
+    ) -> bool:
+        """
+        Saves the result of a test taker, unless they have already taken the test.
+
+        Relies on the unique key of (test_id, taker_chat_id), so concurrent submissions of the same taker 
+        cannot both be saved and no other results of the test have to be read.
+        The user answers are accepted separated by comma or not, and saved packed - one byte per answer.
+        The counters of the chosen letters in question_stats are updated after the result is saved, see _count_answers.
+
+        :returns: True if this was the first attempt of the taker and the result was saved, otherwise False.
+        """
+
+        db = DB()
+
+        user_answers = encode_answers(user_answers)
+        with db.get_cursor() as cursor:
+            inserted = cursor.execute(
+                """INSERT IGNORE INTO test_results (date_taken, test_taker, taker_chat_id, test_id, test_subject, """ \
+                """questions_length, correct_answers, incorrect_answers, user_answers) """ \
+                """VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+                (
+                    date_taken,
+                    test_taker,
+                    taker_chat_id,
+                    test_id,
+                    test_subject,
+                    questions_length,
+                    correct_answers,
+                    incorrect_answers,
+                    user_answers,
+                ),
+            )
+        if inserted == 1:
+            TestResult.counts.invalidate(int(test_id))
+            leaderboard = TestResult.leaderboards.get(int(test_id))
+            if leaderboard is not None:
+                # The key keeps the result from being counted twice when the leaderboard was built after it was saved.
+                leaderboard.add(test_taker, correct_answers, key=taker_chat_id)
+            else:
+                # Keeps a leaderboard that is being built right now, possibly without this result, from being cached.
+                TestResult.leaderboards.invalidate(int(test_id))
+            if user_answers:
+                self._count_answers(test_id, user_answers)
+        return inserted == 1
+
+
+    def _count_answers(self, test_id: int, user_answers: bytes):
+        """
+        Adds the answers of a saved result to the counters of the chosen letters in question_stats.
+
+        Every taker of a test updates the same rows, so the statement is retried when it hits a lock wait timeout 
+        or a deadlock. If it still fails, the error is only printed: the result is saved already and 
+        a taker should not lose it because of the statistics.
+        """
+
+        db = DB()
+
+        query = """INSERT INTO question_stats (test_id, question_no, letter, chosen_count) VALUES %s """ \
+        """ON DUPLICATE KEY UPDATE chosen_count = chosen_count + 1""" % ', '.join(['(%s, %s, %s, 1)'] * len(user_answers))
+        # One row per question and chosen letter, see get_question_stats.
+        values = [
+            value
+            for number, letter in enumerate(user_answers.decode('ascii'), 1)
+            for value in (test_id, number, letter)
+        ]
+        for attempt in range(QUESTION_STATS_RETRIES + 1):
+            try:
+                with db.get_cursor() as cursor:
+                    cursor.execute(query, values)
+            except OperationalError as e:
+                # 1205 - lock wait timeout, 1213 - deadlock.
+                if e.args[0] in (1205, 1213) and attempt < QUESTION_STATS_RETRIES:
+                    time.sleep(0.05 * 2 ** attempt)
+                    continue
+                print('Answers of test %s could not be counted: ' % test_id, e)
+            except Exception as e:
+                print('Answers of test %s could not be counted: ' % test_id, e)
+            return
 
 
 class User:
@@ -419,6 +1880,33 @@ class User:
     A class for modeling bot users.
     """
 
+    # The number of users in the database, counted once per process and then kept up to date 
+    # by add_user and delete_user. None until it is counted.
+    users_count = None
+    users_count_lock = threading.Lock()
+    # chat_id -> the user dictionary, or None for the chat ids that are not registered. 
+    # Every method that changes a user updates or drops its entry.
+    cache = LRUCache(USER_CACHE_SIZE)
+    # Bumped by every change of the users, see VersionCounter.
+    data_version = VersionCounter()
+
+    def add_user(self, chat_id: int, name: str, username: str, is_superuser: int = 0, is_admin: int = 0):
+        """
+        Saves a new user to the database.
+        """
+
+        sk = Storekeeper()
+
+        sk.get_supplies(
+            'users',
+            ['chat_id', 'name', 'username', 'is_superuser', 'is_admin'],
+            [chat_id, name, username, is_superuser, is_admin],
+        )
+        User.cache.invalidate(int(chat_id))
+        self._change_users_count(1)
+        User.data_version.bump()
+
+
     def change_name(self, user_id: str, name: str):
         """
         Changes the user's name.
@@ -426,14 +1914,13 @@ class User:
         
         db = DB()
 
-        connection = db.make_connection()
-        cursor: msdb.cursors.Cursor = connection.cursor()
-        cursor.execute(
-            """UPDATE users SET name = '%s' WHERE chat_id = '%s'""" % \
-            (name, user_id)
-        )
-        connection.commit()
-        db.close_connection(connection, cursor)
+        with db.get_cursor() as cursor:
+            cursor.execute(
+                """UPDATE users SET name = %s WHERE chat_id = %s""",
+                (name, user_id),
+            )
+        User.cache.update(int(user_id), {'name': name})
+        User.data_version.bump()
 
 
     def change_phone_number(self, user_id: str, phone_number: str):
@@ -443,14 +1930,13 @@ class User:
         
         db = DB()
 
-        connection = db.make_connection()
-        cursor: msdb.cursors.Cursor = connection.cursor()
-        cursor.execute(
-            """UPDATE users SET phone_number = '%s' WHERE chat_id = '%s'""" % \
-            (phone_number, user_id)
-        )
-        connection.commit()
-        db.close_connection(connection, cursor)
+        with db.get_cursor() as cursor:
+            cursor.execute(
+                """UPDATE users SET phone_number = %s WHERE chat_id = %s""",
+                (phone_number, user_id),
+            )
+        User.cache.update(int(user_id), {'phone_number': phone_number})
+        User.data_version.bump()
 
 
     def change_school(self, user_id: str, school: str):
@@ -460,14 +1946,13 @@ class User:
         
         db = DB()
 
-        connection = db.make_connection()
-        cursor: msdb.cursors.Cursor = connection.cursor()
-        cursor.execute(
-            """UPDATE users SET school = '%s' WHERE chat_id = '%s'""" % \
-            (school, user_id)
-        )
-        connection.commit()
-        db.close_connection(connection, cursor)
+        with db.get_cursor() as cursor:
+            cursor.execute(
+                """UPDATE users SET school = %s WHERE chat_id = %s""",
+                (school, user_id),
+            )
+        User.cache.update(int(user_id), {'school': school})
+        User.data_version.bump()
 
     
     def delete_user(self, user_id: str):
@@ -477,13 +1962,13 @@ class User:
         
         db = DB()
 
-        connection = db.make_connection()
-        cursor: msdb.cursors.Cursor = connection.cursor()
-        cursor.execute(
-            """DELETE FROM users WHERE chat_id = '%s'""" % user_id
-        )
-        connection.commit()
-        db.close_connection(connection, cursor)
+        with db.get_cursor() as cursor:
+            deleted = cursor.execute(
+                """DELETE FROM users WHERE chat_id = %s""", (user_id,)
+            )
+        User.cache.invalidate(int(user_id))
+        self._change_users_count(-deleted)
+        User.data_version.bump()
     
 
     def get_user_by_name(self, name: str) -> dict:
@@ -494,11 +1979,9 @@ class User:
         db = DB()
 
         if name:
-            connection = db.make_connection()
-            cursor: msdb.cursors.Cursor = connection.cursor()
-            cursor.execute("""SELECT * FROM users WHERE name = '%s'""" % name)
-            result = cursor.fetchone()
-            db.close_connection(connection, cursor)
+            with db.get_cursor() as cursor:
+                cursor.execute("""SELECT * FROM users WHERE name = %s""", (name,))
+                result = cursor.fetchone()
             if result:
                 out_dict = {
                     'chat_id': result[0],
@@ -525,16 +2008,22 @@ class User:
         returns a dictionary containing the data.
 
         Set many to True if you want to get a number of users with the same primary key.
+        Single users looked up by chat_id are served from the in-process cache when possible.
         """
 
         db = DB()
 
         if pk_name and pk_value and all is False and many is False:
-            connection = db.make_connection()
-            cursor: msdb.cursors.Cursor = connection.cursor()
-            cursor.execute("""SELECT * FROM users WHERE {} = '{}'""".format(pk_name, pk_value))
-            result = cursor.fetchone()
-            db.close_connection(connection, cursor)
+            by_chat_id = pk_name == 'chat_id'
+            if by_chat_id:
+                cached = User.cache.get(int(pk_value), default=False)
+                if cached is not False:
+                    return dict(cached) if cached is not None else None
+                generation = User.cache.generation
+            with db.get_cursor() as cursor:
+                cursor.execute("""SELECT * FROM users WHERE {} = %s""".format(check_identifier(pk_name)), (pk_value,))
+                result = cursor.fetchone()
+            resulting_dict = None
             if result:
                 resulting_dict = {
                     'chat_id': result[0],
@@ -545,33 +2034,17 @@ class User:
                     'is_superuser': True if int(result[5]) == 1 else False,
                     'is_admin': True if int(result[6]) == 1 else False,
                 }
-                return resulting_dict
+            if by_chat_id:
+                User.cache.set(int(pk_value), resulting_dict, generation=generation)
+            return dict(resulting_dict) if resulting_dict is not None else None
         elif not pk_name and not pk_value and all is True and many is False:
-            connection = db.make_connection()
-            cursor: msdb.cursors.Cursor = connection.cursor()
-            cursor.execute("""SELECT * FROM users""")
-            results = cursor.fetchall()
-            db.close_connection(connection, cursor)
-            output = []
-            if results:
-                for result in results:
-                    resulting_dict = {
-                        'chat_id': result[0],
-                        'name': result[1],
-                        'phone_number': result[2],
-                        'school': result[3],
-                        'username': "Mavjud emas" if result[4] == 'None' else result[4],
-                        'is_superuser': True if int(result[5]) == 1 else False,
-                        'is_admin': True if int(result[6]) == 1 else False,
-                    }
-                    output.append(resulting_dict)
+            output = list(self.iter_users())
+            if output:
                 return output
         elif pk_name and pk_value and all is False and many is True:
-            connection = db.make_connection()
-            cursor: msdb.cursors.Cursor = connection.cursor()
-            cursor.execute("""SELECT * FROM users WHERE {} = '{}'""".format(pk_name, pk_value))
-            results = cursor.fetchall()
-            db.close_connection(connection, cursor)
+            with db.get_cursor() as cursor:
+                cursor.execute("""SELECT * FROM users WHERE {} = %s""".format(check_identifier(pk_name)), (pk_value,))
+                results = cursor.fetchall()
             output = []
             if results:
                 for result in results:
@@ -589,19 +2062,58 @@ class User:
         return None
     
 
+    def count_users(self) -> int:
+        """
+        Counts the users in the database and resets the in-process counter to the result.
+        """
+
+        db = DB()
+
+        with db.get_cursor() as cursor:
+            cursor.execute("""SELECT COUNT(*) FROM users""")
+            result = cursor.fetchone()
+        with User.users_count_lock:
+            User.users_count = int(result[0])
+        return User.users_count
+
+
     def get_users_count(self) -> int:
         """
         Returns the number of all available users.
+
+        Only the first call in a process reaches the database, the later ones return the in-process counter.
+        """
+
+        users_count = User.users_count
+        return users_count if users_count is not None else self.count_users()
+
+
+    def iter_users(self, chunk_size: int = FETCH_CHUNK_SIZE):
+        """
+        Yields all the users from the database one by one, fetching CHUNK_SIZE rows at a time 
+        through a server-side cursor, so only one chunk is kept in memory.
+
+        The connection is held until the generator is exhausted or closed.
         """
 
         db = DB()
 
-        connection = db.make_connection()
-        cursor: msdb.cursors.Cursor = connection.cursor()
-        cursor.execute("""SELECT chat_id FROM users""")
-        results = cursor.fetchall()
-        db.close_connection(connection, cursor)
-        return len(results)
+        with db.get_cursor(unbuffered=True) as cursor:
+            cursor.execute("""SELECT * FROM users""")
+            while True:
+                results = cursor.fetchmany(chunk_size)
+                if not results:
+                    break
+                for result in results:
+                    yield {
+                        'chat_id': result[0],
+                        'name': result[1],
+                        'phone_number': result[2],
+                        'school': result[3],
+                        'username': "Mavjud emas" if result[4] == 'None' else result[4],
+                        'is_superuser': True if int(result[5]) == 1 else False,
+                        'is_admin': True if int(result[6]) == 1 else False,
+                    }
 
 
     def promote_to_admin(self, chat_id: str):
@@ -614,11 +2126,10 @@ class User:
         user = self.get_user_or_users('chat_id', chat_id)
         if user is not None:
             if int(user['is_admin']) == False:
-                connection = db.make_connection()
-                cursor: msdb.cursors.Cursor = connection.cursor()
-                cursor.execute("""UPDATE users SET is_admin = 1 WHERE chat_id = '%s'""" % chat_id)
-                connection.commit()
-                db.close_connection(connection, cursor)
+                with db.get_cursor() as cursor:
+                    cursor.execute("""UPDATE users SET is_admin = 1 WHERE chat_id = %s""", (chat_id,))
+                User.cache.update(int(chat_id), {'is_admin': True})
+                User.data_version.bump()
             else:
                 raise AttributeError('The user is already an admin!')
         else:
@@ -635,17 +2146,38 @@ class User:
         user = self.get_user_or_users('chat_id', chat_id)
         if user is not None:
             if int(user['is_superuser']) == False:
-                connection = db.make_connection()
-                cursor: msdb.cursors.Cursor = connection.cursor()
-                cursor.execute("""UPDATE users SET is_superuser = 1, is_admin = 1 WHERE chat_id = '%d'""" % chat_id)
-                connection.commit()
-                db.close_connection(connection, cursor)
+                with db.get_cursor() as cursor:
+                    cursor.execute("""UPDATE users SET is_superuser = 1, is_admin = 1 WHERE chat_id = %s""", (chat_id,))
+                User.cache.update(int(chat_id), {'is_superuser': True, 'is_admin': True})
+                User.data_version.bump()
             else:
                 raise AttributeError('The user is already a superuser!')
         else:
             raise ValueError('User with the given id does not exist!')
 
 
+    def _change_users_count(self, difference: int):
+        """
+        Adds the difference to the in-process users counter, if the users have been counted already.
+        """
+
+        with User.users_count_lock:
+            if User.users_count is not None:
+                User.users_count += difference
+
+
+def check_identifier(name: str) -> str:
+    """
+    Returns the given table or column name if it is a plain SQL identifier, otherwise raises ValueError.
+
+    Identifiers cannot be bound as query parameters, so every name that is put into a query string should pass this.
+    """
+
+    if not isinstance(name, str) or not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', name):
+        raise ValueError('Invalid identifier: %r!' % (name,))
+    return name
+
+
 def get_items_in_dict(items: list | tuple) -> dict:
     """
     Places every item in a list to a dict as {index: value} key-value pairs.
@@ -666,19 +2198,6 @@ def get_percent(x: int, y: int) -> int | float:
     return (x / y) * 100
 
 
-def get_test_code(code_length: int, present_codes: list | tuple):
-    """
-    Generates a new code that does not exist in the database.
-    """
-
-    while True:
-        code = random_word(code_length, digits_only=True)
-        if present_codes and code in present_codes:
-            continue
-        else:
-            return code
-
-
 def item_has_space(array: list) -> bool:
     """
     Returns a boolean value based on the result if any item in a list contains space or not.
@@ -748,11 +2267,7 @@ def separate_by(string: str, separator: str) -> str:
     Returns a string the characters of which is separated by comma.
     """
 
-    output = ''
-    for each in string:
-        each += separator
-        output += each
-    resulting = output.rstrip(',')
+    resulting = separator.join(string).rstrip(',')
 
     return resulting
 
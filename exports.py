@@ -0,0 +1,147 @@
+"""
+Excel exports of the bot data.
+
+Workbooks are written in the write-only mode of openpyxl: the rows are taken from the database cursor in chunks
+and appended to the sheet as they come, the headers and column widths are written once, and the file is built
+in memory instead of on the disk.
+
+Building a workbook is CPU-bound, so the exports are run in separate processes - see get_export_executor - 
+which fetch their own data and send back only the finished file.
+"""
+from assistants import Test, User
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from openpyxl import Workbook
+from openpyxl.utils import get_column_letter
+from openpyxl.worksheet.table import Table, TableColumn, TableStyleInfo
+import multiprocessing
+import threading
+
+
+# The number of processes that build the exports, every one of them opens its own database connections.
+EXPORT_WORKERS = 2
+# (header, width) of every column, the first one is the number of the row.
+TESTS_COLUMNS = (
+    ("№", 3),
+    ("Test ID", 10),
+    ("Test fani", 25),
+    ("Tuzuvchi", 30),
+    ("Javoblar", 30),
+    ("Tuzilgan sana", 20),
+    ("To'xtatilgan sana", 20),
+)
+USERS_COLUMNS = (
+    ("№", 3),
+    ("Ismi va familiyasi", 25),
+    ("Telefon raqami", 20),
+    ("Maktab va sinfi", 30),
+    ("Foydalanuvchi nomi", 20),
+)
+
+
+def export_tests() -> tuple:
+    """
+    Writes all the tests to a workbook.
+
+    :returns: A tuple of the workbook file - BytesIO - and the number of tests.
+    """
+
+    rows = (
+        (
+            test['test_id'],
+            test['test_subject'].title().replace('_', ' '),
+            test['creator'].title(),
+            test['answers'].upper(),
+            test['date_created'],
+            "To'xtatilmagan" if test['is_active'] is True else test['date_deactivated'],
+        )
+        for test in Test().iter_tests()
+    )
+    return write_table('Tests', TESTS_COLUMNS, rows)
+
+
+def export_users() -> tuple:
+    """
+    Writes all the users to a workbook.
+
+    :returns: A tuple of the workbook file - BytesIO - and the number of users.
+    """
+
+    rows = (
+        (
+            user['name'].title(),
+            user['phone_number'],
+            user['school'],
+            user['username'].replace('\\_', '_'),
+        )
+        for user in User().iter_users()
+    )
+    return write_table('Users', USERS_COLUMNS, rows)
+
+
+_executor: ProcessPoolExecutor = None
+_executor_lock = threading.Lock()
+
+
+def get_export_executor() -> ProcessPoolExecutor:
+    """
+    Returns the process pool that runs the exports, creating it on the first call.
+
+    The processes are spawned rather than forked, so they do not inherit the pooled connections 
+    and the threads of the bot process.
+    """
+
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ProcessPoolExecutor(
+                    max_workers=EXPORT_WORKERS, 
+                    mp_context=multiprocessing.get_context('spawn'),
+                )
+    return _executor
+
+
+def shutdown_export_executor():
+    """
+    Stops the processes of the export pool, if it has been created, without waiting for the running exports.
+    """
+
+    global _executor
+
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+def write_table(name: str, columns: list | tuple, rows) -> tuple:
+    """
+    Writes the rows to a new workbook as a single styled table, numbering them in the first column.
+
+    :param: name: Accepts a string type of the display name for the table.
+    :param: columns: Accepts a list of (header, width) pairs, see USERS_COLUMNS.
+    :param: rows: Accepts an iterable of rows without the number, it is consumed only once.
+    :returns: A tuple of the workbook file - BytesIO - and the number of rows.
+    """
+
+    wb = Workbook(write_only=True)
+    wsh = wb.create_sheet()
+    for index, (header, width) in enumerate(columns, 1):
+        wsh.column_dimensions[get_column_letter(index)].width = width
+    wsh.append([header for header, width in columns])
+    count = 0
+    for count, row in enumerate(rows, 1):
+        wsh.append((count, *row))
+    # A table needs at least one row besides the header.
+    if count:
+        tab = Table(displayName=name, ref=f'A1:{get_column_letter(len(columns))}{count + 1}')
+        tab.tableStyleInfo = TableStyleInfo(name='TableStyleMedium15')
+        # Header cells cannot be read back in the write-only mode, so the table columns are named here.
+        tab.tableColumns = [TableColumn(id=index, name=header) for index, (header, width) in enumerate(columns, 1)]
+        wsh.add_table(tab)
+    file = BytesIO()
+    wb.save(file)
+    file.seek(0)
+    return file, count
@@ -9,18 +9,23 @@ from aiogram.dispatcher.filters import Text
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, InputFile, KeyboardButton, ReplyKeyboardMarkup
 from aiogram.utils import markdown as md
-from aiogram.utils.exceptions import BadRequest
-from assistants import Channel, \
+from aiogram.utils.exceptions import BadRequest, MessageNotModified
+from assistants import AsyncModel, \
+    Channel, \
     DBFactory, \
+    Migrator, \
+    Outbox, \
+    Sender, \
     Storekeeper, \
+    TTLCache, \
     Test, TestResult, \
     User, \
-    get_items_in_dict, get_percent, get_test_code, \
+    get_percent, \
     item_has_space, \
-    name_valid, \
-    separate_by
-from openpyxl import Workbook
-from openpyxl.worksheet.table import Table, TableStyleInfo
+    name_valid
+from exports import export_tests, export_users, get_export_executor, shutdown_export_executor
+from scoring import decode_answers, encode_answers, grade, grade_many, split_by_mask
+import asyncio
 import logging
 import re
 import time
@@ -31,59 +36,209 @@ bot_owner_id = ''
 bot_owner_url = ''
 superuser_panel_password = ''
 admin_password = ''
+# Seconds a channel membership is trusted before Telegram is asked again. Users who have not subscribed 
+# are rechecked sooner, they also get an immediate recheck by pressing "Obuna bo'ldim ✅".
+membership_member_ttl = 600
+membership_left_ttl = 60
+membership_cache_size = 50000
+# The number of takers shown on one page of the test results.
+results_page_size = 20
 logging.basicConfig(level=logging.INFO)
 bot = Bot(token=API_TOKEN)
 storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
 sk = Storekeeper()
-user_model = User()
 fac = DBFactory()
-channel = Channel()
-test = Test()
-test_results = TestResult()
-if sk.table_exists('users') is False:
-    fac.create_table(
-        'users', 
-        fac.integerfield('chat_id', 'bigint'), 
-        fac.charfield('name', 150, long_text=True), 
-        fac.charfield('phone_number', 20, long_text=True),
-        fac.charfield('school', 100, long_text=True),
-        fac.charfield('username', 100, long_text=True), 
-        fac.integerfield('is_superuser', 'tinyint'), 
-        fac.integerfield('is_admin', 'tinyint'),
-        fac.set_constraint('pk_user', 'chat_id'),
-    )
-if sk.table_exists('tests') is False:
-    fac.create_table(
-        'tests', 
-        fac.integerfield('test_id'),
-        fac.charfield('test_subject', 150, long_text=True),
-        fac.charfield('creator', 150, long_text=True), 
-        fac.charfield('answers', 400, long_text=True), 
-        fac.datetimefield('date_created'),
-        fac.datetimefield('date_deactivated'),
-        fac.integerfield('is_active', 'TINYINT', 1), 
-        fac.set_constraint('pk_test', 'test_id'),
-    )
-if sk.table_exists('test_results') is False:
-    fac.create_table(
-        'test_results',
-        fac.datetimefield('date_taken'),
-        fac.charfield('test_taker', 150, long_text=True),
-        fac.integerfield('test_id'),
-        fac.charfield('test_subject', 150, long_text=True),
-        fac.integerfield('questions_length'),
-        fac.integerfield('correct_answers'),
-        fac.integerfield('incorrect_answers'),
-        fac.charfield('user_answers', 300, long_text=True),
-    )
-if sk.table_exists('channels') is False:
-    fac.create_table(
-        'channels',
-        fac.charfield('username', 300, long_text=True),
-        fac.datetimefield('date_added', date_only=True),
-        fac.set_constraint('pk_channel', 'username'),
+# Models used by the handlers, their methods are awaited and run in the database thread pool.
+user_model = AsyncModel(User())
+channel = AsyncModel(Channel())
+test = AsyncModel(Test())
+test_results = AsyncModel(TestResult())
+# Sends the broadcasts, e.g. test results, within the Telegram rate limits.
+sender = Sender(bot)
+# Keeps the broadcasts in the notifications table until they are sent, its worker is started by on_startup.
+outbox = Outbox(sender)
+outbox_worker = None
+# (channel username, chat id) -> the status of the user in the channel, see get_membership_status.
+membership_cache = TTLCache(membership_member_ttl, max_size=membership_cache_size)
+# 'users' or 'tests' -> the data version, Telegram file_id and, for the tests, the number of rows of the last sent export.
+# An export is sent again by its file_id until the data version of its model is bumped by a change.
+exported_files = {}
+
+
+def prepare_database():
+    """
+    Creates the missing tables and applies the migrations.
+
+    It is called only when the bot is started, not on import, since the export processes import this module too.
+    """
+
+    startup_began = time.monotonic()
+    existing_tables = sk.tables_exist(
+        'users', 'tests', 'test_results', 'channels', 'notifications', 'question_stats', 'sequences',
     )
+    if existing_tables['users'] is False:
+        fac.create_table(
+            'users', 
+            fac.integerfield('chat_id', 'bigint'), 
+            fac.charfield('name', 150, long_text=True), 
+            fac.charfield('phone_number', 20, long_text=True),
+            fac.charfield('school', 100, long_text=True),
+            fac.charfield('username', 100, long_text=True), 
+            fac.integerfield('is_superuser', 'tinyint'), 
+            fac.integerfield('is_admin', 'tinyint'),
+            fac.set_constraint('pk_user', 'chat_id'),
+        )
+    if existing_tables['tests'] is False:
+        fac.create_table(
+            'tests', 
+            fac.integerfield('test_id'),
+            fac.charfield('test_subject', 150, long_text=True),
+            fac.charfield('creator', 150, long_text=True), 
+            fac.charfield('answers', 400, long_text=True), 
+            fac.datetimefield('date_created'),
+            fac.datetimefield('date_deactivated'),
+            fac.integerfield('is_active', 'TINYINT', 1), 
+            fac.set_constraint('pk_test', 'test_id'),
+        )
+    if existing_tables['test_results'] is False:
+        fac.create_table(
+            'test_results',
+            fac.datetimefield('date_taken'),
+            fac.charfield('test_taker', 150, long_text=True),
+            fac.integerfield('test_id'),
+            fac.charfield('test_subject', 150, long_text=True),
+            fac.integerfield('questions_length'),
+            fac.integerfield('correct_answers'),
+            fac.integerfield('incorrect_answers'),
+            fac.charfield('user_answers', 300, long_text=True),
+        )
+    if existing_tables['channels'] is False:
+        fac.create_table(
+            'channels',
+            fac.charfield('username', 300, long_text=True),
+            fac.datetimefield('date_added', date_only=True),
+            fac.set_constraint('pk_channel', 'username'),
+        )
+    if existing_tables['notifications'] is False:
+        fac.create_table(
+            'notifications',
+            fac.autofield('notification_id'),
+            fac.integerfield('chat_id', 'bigint'),
+            fac.charfield('text', 4096, long_text=True),
+            fac.charfield('parse_mode', 20, long_text=True),
+            fac.charfield('reply_markup', 2000, long_text=True),
+            fac.integerfield('status', 'tinyint'),
+            fac.datetimefield('date_created'),
+            fac.datetimefield('date_sent'),
+        )
+    if existing_tables['question_stats'] is False:
+        fac.create_table(
+            'question_stats',
+            fac.integerfield('test_id'),
+            fac.integerfield('question_no', 'smallint'),
+            fac.charfield('letter', 1),
+            fac.integerfield('chosen_count'),
+            fac.set_constraint('pk_question_stats', 'test_id, question_no, letter'),
+        )
+    if existing_tables['sequences'] is False:
+        fac.create_table(
+            'sequences',
+            fac.charfield('sequence_name', 50, long_text=True),
+            fac.integerfield('next_value', 'bigint'),
+            fac.set_constraint('pk_sequence', 'sequence_name'),
+        )
+    # Schema changes applied on top of the tables above, both for new and existing deployments.
+    # Append new migrations to the end of the list with the next version, never change the applied ones.
+    migrations = [
+        {
+            'version': 1,
+            'description': 'Indexes for results by test, users by name and superuser flag, channels by date.',
+            'statements': [
+                fac.add_index('test_results', 'ix_test_results_test_id', ['test_id', 'correct_answers']),
+                fac.add_index('users', 'ix_users_name', 'name'),
+                fac.add_index('users', 'ix_users_is_superuser', 'is_superuser'),
+                fac.add_index('channels', 'ix_channels_date_added', 'date_added'),
+            ],
+        },
+        {
+            'version': 2,
+            'description': 'One result per test taker: a primary key for results and a unique (test_id, test_taker) key.',
+            'statements': [
+                fac.add_column('test_results', fac.autofield('result_id')),
+                # Keeps the first result of every taker who managed to submit a test more than once.
+                """DELETE later FROM test_results AS later JOIN test_results AS earlier """ \
+                """ON later.test_id = earlier.test_id AND later.test_taker = earlier.test_taker """ \
+                """AND later.result_id > earlier.result_id""",
+                fac.add_index('test_results', 'ux_test_results_test_taker', ['test_id', 'test_taker'], unique=True),
+            ],
+        },
+        {
+            'version': 3,
+            'description': 'Packed answers: one byte per answer in BLOB columns instead of letters separated by comma.',
+            'statements': [
+                """UPDATE tests SET answers = REPLACE(answers, ',', '')""",
+                fac.modify_column('tests', fac.blobfield('answers')),
+                """UPDATE test_results SET user_answers = REPLACE(user_answers, ',', '')""",
+                fac.modify_column('test_results', fac.blobfield('user_answers')),
+            ],
+        },
+        {
+            'version': 4,
+            'description': "Results keyed by the taker's chat id instead of their name.",
+            'statements': [
+                fac.add_column('test_results', fac.integerfield('taker_chat_id', 'bigint', default=None), after='test_taker'),
+                # Results saved before this version are matched to the users by name, the ones 
+                # that cannot be matched keep NULL, which does not collide in the unique key below.
+                """UPDATE test_results JOIN users ON users.name = test_results.test_taker """ \
+                """SET test_results.taker_chat_id = users.chat_id WHERE test_results.taker_chat_id IS NULL""",
+                """DELETE later FROM test_results AS later JOIN test_results AS earlier """ \
+                """ON later.test_id = earlier.test_id AND later.taker_chat_id = earlier.taker_chat_id """ \
+                """AND later.result_id > earlier.result_id""",
+                fac.drop_index('test_results', 'ux_test_results_test_taker'),
+                fac.add_index('test_results', 'ux_test_results_taker_chat_id', ['test_id', 'taker_chat_id'], unique=True),
+            ],
+        },
+        {
+            'version': 5,
+            'description': 'Pending notifications of the outbox in the order they were saved.',
+            'statements': [
+                fac.add_index('notifications', 'ix_notifications_status', ['status', 'notification_id']),
+            ],
+        },
+        {
+            'version': 6,
+            'description': 'Per-question counters of the chosen letters for the results saved so far.',
+            'statements': [
+                # Splits the packed answers into one row per question, answers are at most 400 letters long.
+                """INSERT INTO question_stats (test_id, question_no, letter, chosen_count) """ \
+                """WITH RECURSIVE numbers (n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM numbers WHERE n < 400) """ \
+                """SELECT test_results.test_id, numbers.n, SUBSTRING(test_results.user_answers, numbers.n, 1), COUNT(*) """ \
+                """FROM test_results JOIN numbers ON numbers.n <= LENGTH(test_results.user_answers) """ \
+                """GROUP BY test_results.test_id, numbers.n, SUBSTRING(test_results.user_answers, numbers.n, 1) """ \
+                """ON DUPLICATE KEY UPDATE chosen_count = VALUES(chosen_count)""",
+            ],
+        },
+        {
+            'version': 7,
+            'description': 'The sequence of the test ids handed out by Test.allocate_test_id.',
+            'statements': [
+                """INSERT IGNORE INTO sequences (sequence_name, next_value) VALUES ('test_id', 0)""",
+            ],
+        },
+        {
+            'version': 8,
+            'description': 'Batch keys of the notifications saved in bulk, and the sent ones by the time they were sent.',
+            'statements': [
+                fac.add_column('notifications', fac.charfield('batch_key', 32), after='date_sent'),
+                fac.add_index('notifications', 'ix_notifications_batch_key', 'batch_key'),
+                fac.add_index('notifications', 'ix_notifications_date_sent', ['status', 'date_sent']),
+            ],
+        },
+    ]
+    Migrator(migrations).migrate()
+    logging.info('Database schema checked in %.2f seconds.', time.monotonic() - startup_began)
+
 
 # Keyboard buttons
 addChannelBtn = KeyboardButton("Obuna uchun kanal qo'shish ➕")
@@ -169,7 +324,7 @@ async def change_name(message: types.Message, state: FSMContext):
     
     splitted = message.text.split()
     if len(splitted) < 10 and name_valid(splitted) is True:
-        user_model.change_name(message.chat['id'], re.sub(r"[-_'’<>=\\/+|;%*#]", '', message.text))
+        await user_model.change_name(message.chat['id'], re.sub(r"[-_'’<>=\\/+|;%*#]", '', message.text))
         await message.reply(
             "Ma'lumotlar o'zgartirildi 🙂\n\n%s" % md.code('Owned by abduraxmonomonov.uz'),
             parse_mode=types.ParseMode.MARKDOWN_V2,
@@ -213,7 +368,7 @@ async def change_phone_number(message: types.Message, state: FSMContext):
             message.text[1:].isdigit() is True) and 
             len(message.text) <= 20
     ):
-        user_model.change_phone_number(message.chat['id'], message.text)
+        await user_model.change_phone_number(message.chat['id'], message.text)
         await message.reply(
             "Ajoyib\! Telefon raqamingiz o'zgartirildi 🙂\n\n%s" % \
             md.code('Owned by abduraxmonomonov.uz'),
@@ -254,7 +409,7 @@ async def change_school(message: types.Message, state: FSMContext):
         return
     
     if len(message.text) < 50 and message.text[-1] not in '👤📄👨🏻‍✈️📊➕⛔️✅🤨🗂':
-        user_model.change_school(
+        await user_model.change_school(
             message.chat['id'], 
             re.sub(r"[-_'’<>=\\/+|;%*#]", ' ', message.text),
         )
@@ -292,19 +447,19 @@ async def check_subscription(callback_query: types.CallbackQuery):
     Checks if a user has subscribed the channel or not.
     """
 
-    latest_channel = channel.get_channel()
+    latest_channel = await channel.get_channel()
     user_id = callback_query.data.split(':')[-1]
 
     if latest_channel is not None:
         try:
-            result = await bot.get_chat_member(latest_channel['username'], user_id)
+            status = await get_membership_status(latest_channel['username'], user_id, refresh=True)
         except BadRequest:
             await callback_query.answer("Obuna aniqlanmadi! Qaytadan urinib ko'ring.", show_alert=True)
         else:
-            if result['status'] == 'left':
+            if status == 'left':
                 await callback_query.answer("Obuna aniqlanmadi! Qaytadan urinib ko'ring.", show_alert=True)
             else:
-                if user_model.get_user_or_users('chat_id', user_id) is None:
+                if await user_model.get_user_or_users('chat_id', user_id) is None:
                     await callback_query.answer(
                         "Obuna bo'lganingiz uchun rahmat!\n" \
                         "Endi ma'lumotlaringizni kiritib botdan foydalanishingiz mumkin 🙂",
@@ -339,9 +494,8 @@ async def check_test(message: types.Message, state: FSMContext):
     ):
         test_id = int(splitted_message[0])
         # test_subject = str(splitted_message[1]).lower()
-        answers = str(splitted_message[1]).lower().strip()
-        check_answers = separate_by(answers, ',').split(',')
-        test_ = test.get_test(test_id)
+        submission = encode_answers(str(splitted_message[1]).strip())
+        test_ = await test.get_test(test_id)
         if test_ is None:
             await message.reply(
                 "%s raqamli test topilmadi\!\n\nBekor qilish uchun /cancel buyrug'ini kiriting\.\n\n%s" % \
@@ -349,11 +503,9 @@ async def check_test(message: types.Message, state: FSMContext):
                 parse_mode=types.ParseMode.MARKDOWN_V2,
             )
         else:
-            if len(check_answers) == len(str(test_['answers']).split(',')):
+            if len(submission) == len(test_['answer_key']):
                 if test_['is_active'] is True:
-                    correct_answers = get_items_in_dict(str(test_['answers']).split(','))
-                    answers = get_items_in_dict(separate_by(answers, ',').split(','))
-                    await check_results(message, test_id, answers, correct_answers)
+                    await check_results(message, test_id, submission)
                     await state.finish()
                 else:
                     await message.reply(
@@ -382,7 +534,7 @@ async def deny_admin(callback_query: types.CallbackQuery):
     """
 
     chat_id = str(callback_query.data).split(':')[-1]
-    user = user_model.get_user_or_users('chat_id', chat_id)
+    user = await user_model.get_user_or_users('chat_id', chat_id)
     await bot.send_message(
         chat_id,
         "Afsuski, test kiritish huquqi uchun so'rovingiz rad etildi ⛔️\n\n%s" % \
@@ -403,20 +555,22 @@ async def get_admin(message: types.Message):
     Sends superusers to give admin priviliges to the request user.
     """
 
-    superusers = user_model.get_user_or_users('is_superuser', 1, many=True)
-    latest_channel = channel.get_channel()
-    user = user_model.get_user_or_users('chat_id', message.chat['id'])
+    superusers, latest_channel, user = await asyncio.gather(
+        user_model.get_user_or_users('is_superuser', 1, many=True),
+        channel.get_channel(),
+        user_model.get_user_or_users('chat_id', message.chat['id']),
+    )
     
     if user is None:
         if latest_channel is None:
             await no_name(message)
         else:
             try:
-                result = await bot.get_chat_member(latest_channel['username'], message.chat['id'])
+                status = await get_membership_status(latest_channel['username'], message.chat['id'])
             except BadRequest:
                 await no_subscription(message)
             else:
-                if result['status'] == 'left':
+                if status == 'left':
                     await no_subscription(message)
                 else:
                     await no_name(message)
@@ -430,14 +584,16 @@ async def get_admin(message: types.Message):
                 giveAdminBtns.add(
                     InlineKeyboardButton("Rad etish ⛔️", callback_data=f"deny_admin_to:{user['chat_id']}")
                 )
-                for suser in superusers:
-                    await bot.send_message(
-                        suser['chat_id'],
-                        f"{user['name']} test kiritish huquqini so'ramoqda\.\n\n" \
+                await outbox.put([
+                    {
+                        'chat_id': suser['chat_id'],
+                        'text': f"{user['name']} test kiritish huquqini so'ramoqda\.\n\n" \
                         f"{md.code('Owned by abduraxmonomonov.uz')}",
-                        parse_mode=types.ParseMode.MARKDOWN_V2,
-                        reply_markup=giveAdminBtns,
-                    )
+                        'parse_mode': types.ParseMode.MARKDOWN_V2,
+                        'reply_markup': giveAdminBtns.as_json(),
+                    }
+                    for suser in superusers
+                ])
                 await message.reply(
                     "So'rov jo'natildi ✅\n\n%s" % md.code('Owned by abduraxmonomonov.uz'),
                     parse_mode=types.ParseMode.MARKDOWN_V2,
@@ -450,11 +606,11 @@ async def get_admin(message: types.Message):
                 )
         else:
             try:
-                result = await bot.get_chat_member(latest_channel['username'], message.chat['id'])
+                status = await get_membership_status(latest_channel['username'], message.chat['id'])
             except BadRequest:
                 await no_subscription(message)
             else:
-                if result['status'] == 'left':
+                if status == 'left':
                     await no_subscription(message)
                 else:
                     if user['is_superuser'] is False and user['is_admin'] is False:
@@ -465,14 +621,16 @@ async def get_admin(message: types.Message):
                         giveAdminBtns.add(
                             InlineKeyboardButton("Rad etish ⛔️", callback_data=f"deny_admin_to:{user['chat_id']}")
                         )
-                        for superuser in superusers:
-                            await bot.send_message(
-                                superuser['chat_id'],
-                                f"{user['name']} test kiritish huquqini so'ramoqda\.\n\n" \
+                        await outbox.put([
+                            {
+                                'chat_id': superuser['chat_id'],
+                                'text': f"{user['name']} test kiritish huquqini so'ramoqda\.\n\n" \
                                 f"{md.code('Owned by abduraxmonomonov.uz')}",
-                                parse_mode=types.ParseMode.MARKDOWN_V2,
-                                reply_markup=giveAdminBtns,
-                            )
+                                'parse_mode': types.ParseMode.MARKDOWN_V2,
+                                'reply_markup': giveAdminBtns.as_json(),
+                            }
+                            for superuser in superusers
+                        ])
                         await message.reply(
                             "So'rov jo'natildi ✅\n\n%s" % md.code('Owned by abduraxmonomonov.uz'),
                             parse_mode=types.ParseMode.MARKDOWN_V2,
@@ -492,9 +650,9 @@ async def give_admin(callback_query: types.CallbackQuery):
     """
 
     chat_id = str(callback_query.data).split(':')[-1]
-    user = user_model.get_user_or_users('chat_id', chat_id)
+    user = await user_model.get_user_or_users('chat_id', chat_id)
     try:
-        user_model.promote_to_admin(chat_id)
+        await user_model.promote_to_admin(chat_id)
     except AttributeError:
         await callback_query.answer(
             f"{user['name']}ga allaqachon 'admin' unvoni berilgan!", show_alert=True,
@@ -547,18 +705,20 @@ async def my_info(message: types.Message, state: FSMContext):
 
     current_state = await state.get_state()
     if current_state is None:
-        latest_channel = channel.get_channel()
-        user = user_model.get_user_or_users('chat_id', message.chat['id'])
+        latest_channel, user = await asyncio.gather(
+            channel.get_channel(),
+            user_model.get_user_or_users('chat_id', message.chat['id']),
+        )
         if user is None:
             if latest_channel is None:
                 await no_name(message)
             else:
                 try:
-                    result = await bot.get_chat_member(latest_channel['username'], message.chat['id'])
+                    status = await get_membership_status(latest_channel['username'], message.chat['id'])
                 except BadRequest:
                     await no_subscription(message)
                 else:
-                    if result['status'] == 'left':
+                    if status == 'left':
                         await no_subscription(message)
                     else:
                         await no_name(message)
@@ -570,11 +730,11 @@ async def my_info(message: types.Message, state: FSMContext):
                     await send_user_info(message, user)
                 else:
                     try:
-                        result = await bot.get_chat_member(latest_channel['username'], message.chat['id'])
+                        status = await get_membership_status(latest_channel['username'], message.chat['id'])
                     except BadRequest:
                         await no_subscription(message)
                     else:
-                        if result['status'] == 'left':
+                        if status == 'left':
                             await no_subscription(message)
                         else:
                             await send_user_info(message, user)
@@ -589,18 +749,20 @@ async def open_menu(message: types.Message, state: FSMContext):
 
     current_state = await state.get_state()
     if current_state is None:
-        latest_channel = channel.get_channel()
-        user = user_model.get_user_or_users('chat_id', message.chat['id'])
+        latest_channel, user = await asyncio.gather(
+            channel.get_channel(),
+            user_model.get_user_or_users('chat_id', message.chat['id']),
+        )
         if user is None:
             if latest_channel is None:
                 await no_name(message)
             else:
                 try:
-                    result = await bot.get_chat_member(latest_channel['username'], message.chat['id'])
+                    status = await get_membership_status(latest_channel['username'], message.chat['id'])
                 except BadRequest:
                     await no_subscription(message)
                 else:
-                    if result['status'] == 'left':
+                    if status == 'left':
                         await no_subscription(message)
                     else:
                         await no_name(message)
@@ -609,11 +771,11 @@ async def open_menu(message: types.Message, state: FSMContext):
                 await show_appropriate_panel(message, user['is_superuser'], user['is_admin'])
             else:
                 try:
-                    result = await bot.get_chat_member(latest_channel['username'], message.chat['id'])
+                    status = await get_membership_status(latest_channel['username'], message.chat['id'])
                 except BadRequest:
                     await no_subscription(message)
                 else:
-                    if result['status'] == 'left':
+                    if status == 'left':
                         await no_subscription(message)
                     else:
                         await show_appropriate_panel(message, user['is_superuser'], user['is_admin'])
@@ -631,15 +793,13 @@ async def register_name(message: types.Message, state: FSMContext):
 
     splitted = message.text.split()
     if len(splitted) < 10 and name_valid(splitted) is True:
-        columns = ['chat_id', 'name', 'username', 'is_superuser', 'is_admin']
-        values = [
+        await user_model.add_user(
             message.chat['id'], 
             re.sub(r"[-_'’<>=\\/+|;%*#]", '', message.text), 
             str(message.chat['username']).replace('_', '\_'), 
             1 if message.chat['id'] == bot_owner_id else 0, 
             1 if message.chat['id'] == bot_owner_id else 0, 
-        ]
-        sk.get_supplies('users', columns, values)
+        )
         await message.reply(
             f"Tanishganimdan xursandman\!\n\n" \
             f"Endi telefon raqamingizni kiriting\n\n" \
@@ -671,7 +831,7 @@ async def register_phone_number(message: types.Message, state: FSMContext):
             message.text[1:].isdigit() is True) and 
             len(message.text) <= 20
     ):
-        user_model.change_phone_number(message.chat['id'], re.sub(r"[-_'’<>=\\/|;%*#]", ' ', message.text))
+        await user_model.change_phone_number(message.chat['id'], re.sub(r"[-_'’<>=\\/|;%*#]", ' ', message.text))
         await message.reply(
             "Ajoyib\! Telefon raqamingiz ham saqlandi\. " \
             "Navbat maktab va sinfingizga, maktab va sinfingizni kiriting\.\n\n%s" % \
@@ -699,7 +859,7 @@ async def register_school(message: types.Message, state: FSMContext):
         return
     
     if len(message.text) < 50 and message.text[-1] not in '👤📄👨🏻‍✈️📊➕⛔️✅🤨🗂':
-        user_model.change_school(message.chat['id'], re.sub(r'[^a-zA-Z0-9,]', ' ', message.text))
+        await user_model.change_school(message.chat['id'], re.sub(r'[^a-zA-Z0-9,]', ' ', message.text))
         await message.reply(
             "Ajoyib so'nggi ma'lumotlar ham saqlandi\!\n\nBotdan foydalanishingiz mumkin 🙂\n\n%s" % \
             md.code('Owned by abduraxmonomonov.uz'),
@@ -721,19 +881,21 @@ async def set_test_checking_state(message: types.Message):
     Sets the test checking state and tells the user how to send the answers.
     """
 
-    latest_channel = channel.get_channel()
-    user = user_model.get_user_or_users('chat_id', message.chat['id'])
+    latest_channel, user = await asyncio.gather(
+        channel.get_channel(),
+        user_model.get_user_or_users('chat_id', message.chat['id']),
+    )
 
     if user is None:
         if latest_channel is None:
             await no_name(message)
         else:
             try:
-                result = await bot.get_chat_member(latest_channel['username'], message.chat['id'])
+                status = await get_membership_status(latest_channel['username'], message.chat['id'])
             except BadRequest:
                 await no_subscription(message)
             else:
-                if result['status'] == 'left':
+                if status == 'left':
                     await no_subscription(message)
                 else:
                     await no_name(message)
@@ -742,11 +904,11 @@ async def set_test_checking_state(message: types.Message):
             await get_test_answers(message)
         else:
             try:
-                result = await bot.get_chat_member(latest_channel['username'], message.chat['id'])
+                status = await get_membership_status(latest_channel['username'], message.chat['id'])
             except BadRequest:
                 await no_subscription(message)
             else:
-                if result['status'] == 'left':
+                if status == 'left':
                     await no_subscription(message)
                 else:
                     await get_test_answers(message)
@@ -760,18 +922,20 @@ async def welcome_user(message: types.Message, state: FSMContext):
 
     current_state = await state.get_state()
     if current_state is None:
-        latest_channel = channel.get_channel()
-        user = user_model.get_user_or_users('chat_id', message.chat['id'])
+        latest_channel, user = await asyncio.gather(
+            channel.get_channel(),
+            user_model.get_user_or_users('chat_id', message.chat['id']),
+        )
         if user is None:
             if latest_channel is None:
                 await no_name(message)
             else:
                 try:
-                    result = await bot.get_chat_member(latest_channel['username'], message.chat['id'])
+                    status = await get_membership_status(latest_channel['username'], message.chat['id'])
                 except BadRequest:
                     await no_subscription(message)
                 else:
-                    if result['status'] == 'left':
+                    if status == 'left':
                         await no_subscription(message)
                     else:
                         await no_name(message)
@@ -785,7 +949,7 @@ async def welcome_user(message: types.Message, state: FSMContext):
                 await show_appropriate_panel(message, is_superuser, is_admin)
             else:
                 try:
-                    result = await bot.get_chat_member(latest_channel['username'], message.chat['id'])
+                    status = await get_membership_status(latest_channel['username'], message.chat['id'])
                 except BadRequest:
                     text = "Assalomu alaykum, %s\! 👋🏻\n\n" % user['name']
                     text2 = "Sizni qayta ko'rib turganimdan xursandman 🙂 " \
@@ -800,7 +964,7 @@ async def welcome_user(message: types.Message, state: FSMContext):
                     )
                     await message.reply(text + text2, parse_mode=types.ParseMode.MARKDOWN_V2, reply_markup=subscribeBtns)
                 else:
-                    if result['status'] == 'left':
+                    if status == 'left':
                         text = "Assalomu alaykum, %s\! 👋🏻\n\n" % user['name']
                         text2 = "Sizni qayta ko'rib turganimdan xursandman 🙂 " \
                         "Biroq, Kanalimizdan chiqib ketganga o'xshaysiz 🤨" \
@@ -841,14 +1005,14 @@ async def give_superuser(message: types.Message, state: FSMContext):
 
     splitted = message.text.split()
     if len(splitted) < 10 and name_valid(splitted) is True:
-        user = user_model.get_user_by_name(re.sub(r"[-_'’<>=\\/+|;%*#]", '', message.text))
+        user = await user_model.get_user_by_name(re.sub(r"[-_'’<>=\\/+|;%*#]", '', message.text))
         if user is None:
             await message.reply(
                 f"{message.text} ismli foydalanuvchi bazada mavjud emas!"
             )
         else:
             try:
-                user_model.promote_to_superuser(user['chat_id'])
+                await user_model.promote_to_superuser(user['chat_id'])
             except AttributeError:
                 await message.reply(
                     f"{user['name']}ga allaqachon oliy admin unvoni berilgan!",
@@ -878,7 +1042,7 @@ async def give_superuser_state(message: types.Message):
     Gives superuser priviliges to a user
     """
 
-    user = user_model.get_user_or_users('chat_id', message.chat['id'])
+    user = await user_model.get_user_or_users('chat_id', message.chat['id'])
 
     if user['is_superuser'] is True and user['is_admin'] is True and user['chat_id'] == bot_owner_id:
         await Form.give_superuser.set()
@@ -900,7 +1064,7 @@ async def add_channel(message: types.Message):
     Gets the request to add a channel to the database.
     """
 
-    user = user_model.get_user_or_users('chat_id', message.chat['id'])
+    user = await user_model.get_user_or_users('chat_id', message.chat['id'])
 
     if user is not None and (user['is_superuser'] is True or user['chat_id'] == bot_owner_id):
         await Form.add_channel.set()
@@ -924,20 +1088,12 @@ async def check_channel_name(message: types.Message, state: FSMContext):
     if current_state is None:
         return
     
-    channels = channel.get_channel_usernames()
+    channels = await channel.get_channel_usernames()
     format = message.text.split()
     if channels:
         if message.text not in channels:
             if message.text.startswith('@') and len(format) == 1 and not re.findall(r'[^a-zA-Z0-9@_]', message.text):
-                columns = [
-                    'username',
-                    'date_added',
-                ]
-                values = [
-                    message.text,
-                    time.strftime(r"%Y-%m-%d", time.localtime()),
-                ]
-                sk.get_supplies('channels', columns, values)
+                await channel.add_channel(message.text, time.strftime(r"%Y-%m-%d", time.localtime()))
                 await message.reply(
                     "Kanal qo'shildi 👍🏻\n\n%s" % md.code('Owned by abduraxmonomonov.uz'),
                     parse_mode=types.ParseMode.MARKDOWN_V2,
@@ -957,15 +1113,7 @@ async def check_channel_name(message: types.Message, state: FSMContext):
             )
     else:
         if message.text.startswith('@') and len(format) == 1 and not re.findall(r'[^a-zA-Z0-9@_]', message.text):
-            columns = [
-                'username',
-                'date_added',
-            ]
-            values = [
-                message.text,
-                time.strftime(r"%Y-%m-%d", time.localtime()),
-            ]
-            sk.get_supplies('channels', columns, values)
+            await channel.add_channel(message.text, time.strftime(r"%Y-%m-%d", time.localtime()))
             await message.reply("Kanal qo'shildi 👍🏻\n\n%s" % md.code('Owned by abduraxmonomonov.uz'))
             await state.finish()
         else:
@@ -1012,9 +1160,9 @@ async def delete_user(message: types.Message, state: FSMContext):
     
     splitted = message.text.split()
     if len(splitted) < 10 and name_valid(splitted) is True:
-        user = user_model.get_user_by_name(re.sub(r"[-_'’<>=\\/+|;%*#]", '', message.text))
+        user = await user_model.get_user_by_name(re.sub(r"[-_'’<>=\\/+|;%*#]", '', message.text))
         if user:
-            user_model.delete_user(user['chat_id'])
+            await user_model.delete_user(user['chat_id'])
             await message.reply(
                 f"{user['chat_id']} raqamli foydalanuvchi bazadan o'chirildi\.\n\n" \
                 f"{md.code('Owned by abduraxmonomonov.uz')}",
@@ -1041,7 +1189,7 @@ async def delete_user_state(message: types.Message):
     Deletes the specified user.
     """
 
-    user = user_model.get_user_or_users('chat_id', message.chat['id'])
+    user = await user_model.get_user_or_users('chat_id', message.chat['id'])
     if user['is_superuser']:
         await Form.delete_user.set()
         await message.reply(
@@ -1059,38 +1207,25 @@ async def get_users(message: types.Message):
     Tells how many users are using the bot.
     """
 
-    user = user_model.get_user_or_users('chat_id', message.chat['id'])
+    user = await user_model.get_user_or_users('chat_id', message.chat['id'])
 
     if user is not None and (user['is_superuser'] is True or user['chat_id'] == bot_owner_id):
-        users = user_model.get_user_or_users(all=True)
-        wb = Workbook()
-        wsh = wb.active
-        tab = Table(displayName='Users', ref=f'A1:E{len(users) + 1}')
-        style = TableStyleInfo(name='TableStyleMedium15')
-        tab.tableStyleInfo = style
-        for index, usr in enumerate(users):
-            index += 1
-            wsh['A1'] = "№"
-            wsh['B1'] = "Ismi va familiyasi"
-            wsh['C1'] = "Telefon raqami"
-            wsh['D1'] = "Maktab va sinfi"
-            wsh['E1'] = "Foydalanuvchi nomi"
-            wsh[f"A{index + 1}"] = index
-            wsh[f"B{index + 1}"] = usr['name'].title()
-            wsh[f"C{index + 1}"] = usr['phone_number']
-            wsh[f"D{index + 1}"] = usr['school']
-            wsh[f"E{index + 1}"] = usr['username'].replace('\_', '_')
-            wsh.column_dimensions['A'].width = 3
-            wsh.column_dimensions['B'].width = 25
-            wsh.column_dimensions['C'].width = 20
-            wsh.column_dimensions['D'].width = 30
-            wsh.column_dimensions['E'].width = 20
-        wsh.add_table(tab)
-        wb.save('users.xlsx')
-        file = InputFile('users.xlsx')
+        data_version = User.data_version.value
+        exported = exported_files.get('users')
+        if exported is not None and exported['data_version'] == data_version:
+            document = exported['file_id']
+        else:
+            loop = asyncio.get_running_loop()
+            workbook, _ = await loop.run_in_executor(get_export_executor(), export_users)
+            document = InputFile(workbook, filename='users.xlsx')
+        users_count = await user_model.get_users_count()
         caption = f"{time.strftime(r'%Y/%m/%d %H:%M:%S', time.localtime())} " \
-        "holatiga ko'ra %dta foydalanuvchi mavjud\.\n\n%s" % (len(users), md.code('Owned by abduraxmonomonov.uz'))
-        await message.reply_document(file, caption=caption, parse_mode=types.ParseMode.MARKDOWN_V2)
+        "holatiga ko'ra %dta foydalanuvchi mavjud\.\n\n%s" % (users_count, md.code('Owned by abduraxmonomonov.uz'))
+        sent = await message.reply_document(document, caption=caption, parse_mode=types.ParseMode.MARKDOWN_V2)
+        exported_files['users'] = {
+            'data_version': data_version,
+            'file_id': sent.document.file_id,
+        }
     else:
         await unknown_command(message)
 
@@ -1101,7 +1236,7 @@ async def open_superuser_panel(message: types.Message):
     Opens the superuser panel, requiring the fixed password.
     """
 
-    user = user_model.get_user_or_users('chat_id', message.chat['id'])
+    user = await user_model.get_user_or_users('chat_id', message.chat['id'])
 
     if user is not None and (user['is_superuser'] is True or message.chat['id'] == bot_owner_id):
         await Form.superuser_password.set()
@@ -1119,45 +1254,30 @@ async def show_tests(message: types.Message):
     Show all the available tests in the database.
     """
 
-    user = user_model.get_user_or_users('chat_id', message.chat['id'])
+    user = await user_model.get_user_or_users('chat_id', message.chat['id'])
 
     if user is not None and (user['is_superuser'] is True or message.chat['id'] == bot_owner_id):
-        tests = test.get_tests()
-        if tests:
-            wb = Workbook()
-            wsh = wb.active
-            tab = Table(displayName='Tests', ref=f'A1:G{len(tests) + 1}')
-            style = TableStyleInfo(name='TableStyleMedium15')
-            tab.tableStyleInfo = style
-            for index, test_ in enumerate(tests):
-                index += 1
-                wsh['A1'] = "№"
-                wsh['B1'] = "Test ID"
-                wsh['C1'] = "Test fani"
-                wsh['D1'] = "Tuzuvchi"
-                wsh['E1'] = "Javoblar"
-                wsh['F1'] = "Tuzilgan sana"
-                wsh['G1'] = "To'xtatilgan sana"
-                wsh[f"A{index + 1}"] = index
-                wsh[f"B{index + 1}"] = test_['test_id']
-                wsh[f"C{index + 1}"] = test_['test_subject'].title().replace('_', ' ')
-                wsh[f"D{index + 1}"] = test_['creator'].title()
-                wsh[f"E{index + 1}"] = test_['answers'].upper()
-                wsh[f"F{index + 1}"] = test_['date_created']
-                wsh[f"G{index + 1}"] = "To'xtatilmagan" if test_['is_active'] is True else test_['date_deactivated']
-                wsh.column_dimensions['A'].width = 3
-                wsh.column_dimensions['B'].width = 10
-                wsh.column_dimensions['C'].width = 25
-                wsh.column_dimensions['D'].width = 30
-                wsh.column_dimensions['E'].width = 30
-                wsh.column_dimensions['F'].width = 20
-                wsh.column_dimensions['G'].width = 20
-            wsh.add_table(tab)
-            wb.save('tests.xlsx')
-            file = InputFile('tests.xlsx')
+        data_version = Test.data_version.value
+        exported = exported_files.get('tests')
+        if exported is not None and exported['data_version'] == data_version:
+            document, tests_count = exported['file_id'], exported['count']
+        else:
+            loop = asyncio.get_running_loop()
+            workbook, tests_count = await loop.run_in_executor(get_export_executor(), export_tests)
+            document = InputFile(workbook, filename='tests.xlsx')
+        if tests_count:
+            usage = await test.get_test_id_usage()
+            used_percent = md.escape_md('%.1f' % usage['percent'])
             caption = f"{time.strftime(r'%Y/%m/%d %H:%M:%S', time.localtime())} " \
-            "holatiga ko'ra %dta test mavjud\.\n\n%s" % (len(tests), md.code('Owned by abduraxmonomonov.uz'))
-            await message.reply_document(file, caption=caption, parse_mode=types.ParseMode.MARKDOWN_V2)
+            f"holatiga ko'ra {tests_count}ta test mavjud\.\n" \
+            f"Test raqamlaridan {usage['used']}/{usage['capacity']} \({used_percent}%\) band\.\n\n" \
+            f"{md.code('Owned by abduraxmonomonov.uz')}"
+            sent = await message.reply_document(document, caption=caption, parse_mode=types.ParseMode.MARKDOWN_V2)
+            exported_files['tests'] = {
+                'data_version': data_version,
+                'file_id': sent.document.file_id,
+                'count': tests_count,
+            }
         else:
             await message.reply(
                 f"""{time.strftime(r"%Y/%m/%d %H:%M:%S", time.localtime())} holatiga ko'ra 0ta test mavjud\.\n\n""" \
@@ -1179,33 +1299,25 @@ async def add_test(message: types.Message, state: FSMContext):
     if current_state is None:
         return
 
-    user = user_model.get_user_or_users('chat_id', message.chat['id'])
+    user = await user_model.get_user_or_users('chat_id', message.chat['id'])
     text = message.text.split(':')
     if len(text) == 2 and item_has_space(text) is False and not re.findall(r'[^a-zA-Z0-9_]', text[0]) and not re.findall(r'[^a-zA-Z]', text[1]):
-        ids = test.get_all_test_ids()
-        test_id = get_test_code(5, ids)
+        try:
+            test_id = await test.allocate_test_id()
+        except ValueError:
+            await message.reply(
+                "Bo'sh test raqamlari qolmadi, testni qo'shib bo'lmaydi 😕\n\n%s" % \
+                md.code('Owned by abduraxmonomonov.uz'),
+                parse_mode=types.ParseMode.MARKDOWN_V2,
+            )
+            await state.finish()
+            return
         test_subject = str(text[0]).lower()
         creator = user['name']
-        answers = separate_by(str(text[-1]).lower(), ',')
+        answers = decode_answers(encode_answers(text[-1]))
         questions_number = len(answers.split(','))
         date_created = time.strftime(r"%Y-%m-%d %H:%M:%S", time.localtime())
-        sk.get_supplies(
-            'tests',
-            [
-                'test_id',
-                'test_subject',
-                'creator',
-                'answers',
-                'date_created',
-            ],
-            [
-                test_id,
-                test_subject,
-                creator,
-                answers,
-                date_created,
-            ],
-        )
+        await test.add_test(test_id, test_subject, creator, answers, date_created)
         stopTestBtns = InlineKeyboardMarkup()
         await message.reply(
             f"Test raqami: {test_id}\n" \
@@ -1236,20 +1348,17 @@ async def cancel_test(callback_query: types.CallbackQuery):
     """
 
     test_id = str(callback_query.data).split(':')[-1]
-    test_ = test.get_test(test_id)
+    test_ = await test.get_test(test_id)
 
     if test_ and test_['is_active'] is True:
         try:
-            test.deactivate(test_id)
+            await test.deactivate(test_id)
         except ValueError:
             await callback_query.answer("%s raqamli test mavjud emas!" % test_id, show_alert=True)
         except AttributeError:
             await callback_query.answer("%s raqamli test allaqachon to'xtatilgan!" % test_id, show_alert=True)
         else:
-            dicted_answers = get_items_in_dict(str(test_['answers']).split(','))
-            results = test_results.get_results(test_['test_id'])
-            if results:
-                await send_test_results(callback_query.message, test_, results, dicted_answers)
+            await send_test_results(callback_query.message, test_)
             await callback_query.message.answer(
                 "Test to'xtatildi\! Natijalarni menyu orqali ko'rishingiz mumkin 🙂\n\n%s" % \
                 md.code('Owned by abduraxmonomonov.uz'),
@@ -1263,7 +1372,7 @@ async def get_new_test(message: types.Message):
     Tells a user how to send the answers
     """
 
-    user = user_model.get_user_or_users('chat_id', message.chat['id'])
+    user = await user_model.get_user_or_users('chat_id', message.chat['id'])
 
     if user is not None:
         if user['is_superuser'] == True or user['is_admin'] == True or user['chat_id'] == bot_owner_id:
@@ -1289,7 +1398,7 @@ async def get_test_id(message: types.Message):
     Returns the test results by the test creator.
     """
 
-    user = user_model.get_user_or_users('chat_id', message.chat['id'])
+    user = await user_model.get_user_or_users('chat_id', message.chat['id'])
 
     if user is not None and (user['is_admin'] is True or user['is_superuser'] is True):
         await Form.test_results.set()
@@ -1312,26 +1421,17 @@ async def get_test_results(message: types.Message, state: FSMContext):
         return
     
     if len(message.text) == 5 and message.text.isdigit():
-        test_ = test.get_test(message.text)
+        test_ = await test.get_test(message.text)
         if test_ is not None:
-            results = test_results.get_results(test_['test_id'])
-            is_active = "to'xtatilmagan" if test_['is_active'] is True else str(test_['end_date']).replace('-', '/')
+            # The results of active tests are taken from their leaderboards.
+            questions_length = len(test_['answer_key']) if test_['is_active'] is True else None
+            results, results_count = await asyncio.gather(
+                test_results.get_results_page(test_['test_id'], results_page_size, 0, questions_length),
+                test_results.count_results(test_['test_id']),
+            )
             if results:
-                out_msg = f"Test raqami: {test_['test_id']}\n" \
-                f"Test fani: {str(test_['test_subject']).title().replace('_', ' ')}\n" \
-                f"Tuzuvchi: {test_['creator']}\n" \
-                f"Savollar soni: {len(str(test_['answers']).split(','))}\n" \
-                f"Tuzilgan sana: {str(test_['start_date']).replace('-', '/')}\n" \
-                f"To'xtatilgan sana: {is_active}\n\n" \
-                f"{time.strftime(r'%Y/%m/%d %H:%M:%S', time.localtime())} holati bo'yicha natijalar:\n\n"
-                # Value here is a dict
-                for index, value in enumerate(results):
-                    out_msg += f"{index + 1}\. {value['test_taker']} \- {value['correct_answers']} ✅\n"
-                out_msg = out_msg + '\n' + md.code('Owned by abduraxmonomonov.uz')
-                await message.reply(
-                    out_msg,
-                    parse_mode=types.ParseMode.MARKDOWN_V2,
-                )
+                text, resultsPageBtns = make_results_page(test_, results, 0, results_count)
+                await message.reply(text, parse_mode=types.ParseMode.MARKDOWN_V2, reply_markup=resultsPageBtns)
                 await state.finish()
             else:
                 await message.reply(
@@ -1352,6 +1452,60 @@ async def get_test_results(message: types.Message, state: FSMContext):
         )
 
 
+@dp.callback_query_handler(lambda callback: str(callback.data).startswith('question_stats:'))
+async def show_question_stats(callback_query: types.CallbackQuery):
+    """
+    Shows how the takers answered every question of the test, the most often missed questions first.
+    """
+
+    test_id = str(callback_query.data).split(':')[-1]
+    user, test_ = await asyncio.gather(
+        user_model.get_user_or_users('chat_id', callback_query.from_user.id),
+        test.get_test(test_id),
+    )
+
+    if user is not None and (user['is_admin'] is True or user['is_superuser'] is True) and test_ is not None:
+        stats = await test_results.get_question_stats(test_id, test_['answer_key'])
+        for text in make_question_stats(test_, stats):
+            await callback_query.message.answer(text, parse_mode=types.ParseMode.MARKDOWN_V2)
+    await callback_query.answer()
+
+
+@dp.callback_query_handler(lambda callback: str(callback.data).startswith('results_page:'))
+async def show_results_page(callback_query: types.CallbackQuery):
+    """
+    Shows another page of the test results, editing the message in place.
+    """
+
+    _, test_id, page = str(callback_query.data).split(':')
+    user, test_, results_count = await asyncio.gather(
+        user_model.get_user_or_users('chat_id', callback_query.from_user.id),
+        test.get_test(test_id),
+        test_results.count_results(test_id),
+    )
+
+    if user is not None and (user['is_admin'] is True or user['is_superuser'] is True) and test_ is not None:
+        # The number of results may have changed since the buttons were made, so the page is kept in range.
+        page = min(max(int(page), 0), max(results_count - 1, 0) // results_page_size)
+        questions_length = len(test_['answer_key']) if test_['is_active'] is True else None
+        results = await test_results.get_results_page(
+            test_id, 
+            results_page_size, 
+            page * results_page_size, 
+            questions_length,
+        )
+        text, resultsPageBtns = make_results_page(test_, results, page, results_count)
+        try:
+            await callback_query.message.edit_text(
+                text, 
+                parse_mode=types.ParseMode.MARKDOWN_V2, 
+                reply_markup=resultsPageBtns,
+            )
+        except MessageNotModified:
+            pass
+    await callback_query.answer()
+
+
 @dp.message_handler(state=Form.stop_test)
 async def stop_test(message: types.Message, state: FSMContext):
     """
@@ -1363,10 +1517,10 @@ async def stop_test(message: types.Message, state: FSMContext):
         return
 
     if len(message.text) == 5 and message.text.isdigit():
-        test_ = test.get_test(message.text)
+        test_ = await test.get_test(message.text)
         if test_ is not None:
             try:
-                test.deactivate(test_['test_id'])
+                await test.deactivate(test_['test_id'])
             except AttributeError:
                 await message.reply(
                     f"{test_['test_id']} raqamli test allaqachon to'xtatilgan\!\n\n " \
@@ -1374,10 +1528,7 @@ async def stop_test(message: types.Message, state: FSMContext):
                     parse_mode=types.ParseMode.MARKDOWN_V2,
                 )
             else:
-                dicted_answers = get_items_in_dict(str(test_['answers']).split(','))
-                results = test_results.get_results(test_['test_id'])
-                if results:
-                    await send_test_results(message, test_, results, dicted_answers)
+                if await send_test_results(message, test_):
                     await state.finish()
                 else:
                     await message.reply(
@@ -1405,7 +1556,7 @@ async def stop_test_state(message: types.Message):
     Sets the STOP TEST state and tells the user to send the test id to stop that test.
     """
 
-    user = user_model.get_user_or_users('chat_id', message.chat['id'])
+    user = await user_model.get_user_or_users('chat_id', message.chat['id'])
 
     if user is not None and (user['is_superuser'] is True or user['is_admin'] is True):
         await Form.stop_test.set()
@@ -1419,59 +1570,76 @@ async def stop_test_state(message: types.Message):
 
 
 # Assisting async functions
-async def check_results(message: types.Message, test_id: str, answers: dict, correct_answers: dict):
+async def check_results(message: types.Message, test_id: str, submission: bytes):
     """
     Checks the test answers and returns correct and incorrect answers to a user.
+
+    The submission should be encoded by scoring.encode_answers.
     """
 
-    user = user_model.get_user_or_users('chat_id', message.chat['id'])
-    test_ = test.get_test(test_id)
-    results = test_results.get_results(test_id)
-    the_attended = []
-    if results:
-        for result in results:
-            the_attended.append(result['test_taker'])
-    incorrect_answers = list(answers.items() - correct_answers.items())
-    correct_ones = len(correct_answers) - len(incorrect_answers)
+    user, test_ = await asyncio.gather(
+        user_model.get_user_or_users('chat_id', message.chat['id']),
+        test.get_test(test_id),
+    )
+    graded = grade(test_['answer_key'], submission)
+    correct_ones = graded['correct']
+    incorrect_ones = graded['incorrect']
+    questions_length = len(test_['answer_key'])
     date_taken = time.strftime(r"%Y/%m/%d %H:%M:%S", time.localtime())
-    if f"{user['name']}" not in the_attended:
-        sk.get_supplies(
-            'test_results',
-            [
-                'date_taken',
-                'test_taker',
-                'test_id',
-                'test_subject',
-                'questions_length',
-                'correct_answers',
-                'incorrect_answers',
-                'user_answers',
-            ],
-            [
-                date_taken,
-                user['name'],
-                test_id,
-                test_['test_subject'],
-                len(str(test_['answers']).split(',')),
-                correct_ones,
-                len(incorrect_answers),
-                ','.join([value for value in answers.values()]),
-            ],
-        )
+    # Saved only on the first attempt of the user, the later ones are just checked.
+    saved = await test_results.submit(
+        date_taken,
+        user['name'],
+        user['chat_id'],
+        test_id,
+        test_['test_subject'],
+        questions_length,
+        correct_ones,
+        incorrect_ones,
+        submission,
+    )
+    standing = ''
+    if saved and test_['is_active'] is True:
+        rank = await test_results.get_rank(test_id, questions_length, correct_ones)
+        standing = f"Reytingdagi o'rningiz: {rank['rank']}/{rank['count']} 🏆\n\n"
     await message.reply(
             f"Test topshirilgan sana: {time.strftime(r'%Y/%m/%d %H:%M:%S', time.localtime())}\n" \
             f"Topshiruvchi: {user['name']}\n" \
             f"Test fani: {str(test_['test_subject']).title().replace('_', ' ')}\n\n" \
             f"Tog'ri javoblar soni: {correct_ones} ✅\n" \
-            f"Noto'g'ri javoblar soni: {len(incorrect_answers)} ❌\n" \
-            f"To'g'ri javoblar foizda: {int(get_percent(correct_ones, len(correct_answers)))}%\n" \
-            f"Noto'g'ri javoblar foizda: {int(get_percent(len(incorrect_answers), len(correct_answers)))}%\n\n" \
+            f"Noto'g'ri javoblar soni: {incorrect_ones} ❌\n" \
+            f"To'g'ri javoblar foizda: {int(get_percent(correct_ones, questions_length))}%\n" \
+            f"Noto'g'ri javoblar foizda: {int(get_percent(incorrect_ones, questions_length))}%\n\n" \
+            f"{standing}" \
             "Natijalaringiz haqida to'liq ma'lumotlar test yakunlanganidan so'ng yuboriladi\. " +
             "Testda ishtirok etganingiz uchun raxmat 🙂\n\n%s" % md.code("Owned by abduraxmonomonov.uz"),
             parse_mode=types.ParseMode.MARKDOWN_V2,
         )
 
 
+async def get_membership_status(channel_username: str, chat_id: int | str, refresh: bool = False) -> str:
+    """
+    Returns the status of the user in the channel ('member', 'left', ...), asking Telegram only if it is not cached.
+
+    Set refresh to True to skip the cache and ask Telegram anyway. 
+    BadRequest raised by Telegram is not caught, and nothing is cached in that case.
+    """
+
+    key = (channel_username, int(chat_id))
+    if refresh is False:
+        status = membership_cache.get(key)
+        if status is not None:
+            return status
+    result = await bot.get_chat_member(channel_username, chat_id)
+    status = result['status']
+    membership_cache.set(
+        key, 
+        status, 
+        ttl=membership_left_ttl if status in ('left', 'kicked') else membership_member_ttl,
+    )
+    return status
+
+
 async def get_test_answers(message: types.Message):
     """
     Tells a user how to send test answers.
@@ -1483,6 +1651,109 @@ async def get_test_answers(message: types.Message):
     await message.reply(text + text2, parse_mode=types.ParseMode.MARKDOWN_V2)
 
 
+def make_question_stats(test_: dict, stats: list | tuple) -> list:
+    """
+    Makes the texts of the question statistics, the questions with the lowest share of correct answers first.
+
+    The statistics are split into several messages when they do not fit into one.
+    """
+
+    header = f"{test_['test_id']} raqamli test savollari tahlili 📈\n" \
+    "Savol raqami, to'g'ri javob, to'g'ri javob berganlar va tanlangan javoblar:\n\n"
+    footer = '\n' + md.code('Owned by abduraxmonomonov.uz')
+    for question in stats:
+        question['percent'] = int(get_percent(question['correct'], question['count'])) if question['count'] else 0
+    lines = []
+    for question in sorted(stats, key=lambda question: (question['percent'], question['question_no'])):
+        correct_letter = chr(test_['answer_key'][question['question_no'] - 1]).upper()
+        chosen = ', '.join(
+            [f"{md.escape_md(letter.upper())}: {count}" for letter, count in sorted(question['chosen'].items())]
+        )
+        lines.append(
+            f"{question['question_no']}\. {correct_letter} \- {question['correct']}/{question['count']} ✅ " \
+            f"\({question['percent']}%\) \| {chosen or '—'}\n"
+        )
+    texts = []
+    text = header
+    for line in lines:
+        # Telegram messages are limited to 4096 characters.
+        if len(text) + len(line) + len(footer) > 4000:
+            texts.append(text + footer)
+            text = ''
+        text += line
+    texts.append(text + footer)
+    return texts
+
+
+def make_result_messages(test_: dict, results: list | tuple) -> list:
+    """
+    Makes the outbox messages that tell the test takers their correct and incorrect answers.
+
+    The results should contain the chat ids of the takers, see TestResult.iter_results_with_recipients.
+    """
+
+    answer_key = test_['answer_key']
+    submissions = [encode_answers(result['user_answers'], len(answer_key)) for result in results]
+    messages = []
+    for result, submission, graded in zip(results, submissions, grade_many(answer_key, submissions)):
+        name = str(result['test_taker'])
+        correct_answers, incorrect_answers = split_by_mask(submission, graded['mask'])
+        str_cor_ans = ' ✅ '.join([f'{number}\. {letter.upper()}' for number, letter in correct_answers])
+        str_inc_ans = ' ❌ '.join([f'{number}\. {letter.upper()}' for number, letter in incorrect_answers])
+        str_cor_ans += ' ✅ '
+        str_inc_ans += ' ❌ '
+        msg_to_taker = f"{test_['test_id']} raqamli test yakunlandi\.\n\n" \
+        f"Test topshiruvchi: {name}\n" \
+        f"To'g'ri javoblar\({len(correct_answers)}\):\n\n {str_cor_ans}\n\n" \
+        f"Noto'g'ri javoblar\({len(incorrect_answers)}\):\n\n {str_inc_ans}\n\n" \
+        f"{md.code('Owned by abduraxmonomonov.uz')}"
+        messages.append(
+            {'chat_id': result['chat_id'], 'text': msg_to_taker, 'parse_mode': types.ParseMode.MARKDOWN_V2}
+        )
+    return messages
+
+
+def make_results_page(test_: dict, results: list | tuple, page: int, results_count: int) -> tuple:
+    """
+    Makes the text of a page of the test results along with the buttons to the previous and next pages.
+
+    The results should contain the ranks of the takers, see TestResult.get_results_page.
+    """
+
+    is_active = "to'xtatilmagan" if test_['is_active'] is True else str(test_['end_date']).replace('-', '/')
+    pages_count = max(results_count - 1, 0) // results_page_size + 1
+    text = f"Test raqami: {test_['test_id']}\n" \
+    f"Test fani: {str(test_['test_subject']).title().replace('_', ' ')}\n" \
+    f"Tuzuvchi: {test_['creator']}\n" \
+    f"Savollar soni: {len(test_['answer_key'])}\n" \
+    f"Tuzilgan sana: {str(test_['start_date']).replace('-', '/')}\n" \
+    f"To'xtatilgan sana: {is_active}\n" \
+    f"Qatnashchilar soni: {results_count}\n\n" \
+    f"{time.strftime(r'%Y/%m/%d %H:%M:%S', time.localtime())} holati bo'yicha natijalar " \
+    f"\({page + 1}/{pages_count}\):\n\n"
+    for result in results:
+        # Names are cut, so that a full page always fits into a single message.
+        name = md.escape_md(str(result['test_taker'])[:60])
+        text += f"{result['rank']}\. {name} \- {result['correct_answers']} ✅\n"
+    text += '\n' + md.code('Owned by abduraxmonomonov.uz')
+    resultsPageBtns = InlineKeyboardMarkup()
+    buttons = []
+    if page > 0:
+        buttons.append(
+            InlineKeyboardButton("⬅️ Oldingi", callback_data=f"results_page:{test_['test_id']}:{page - 1}")
+        )
+    if page < pages_count - 1:
+        buttons.append(
+            InlineKeyboardButton("Keyingi ➡️", callback_data=f"results_page:{test_['test_id']}:{page + 1}")
+        )
+    if buttons:
+        resultsPageBtns.row(*buttons)
+    resultsPageBtns.add(
+        InlineKeyboardButton("Savollar tahlili 📈", callback_data=f"question_stats:{test_['test_id']}")
+    )
+    return text, resultsPageBtns
+
+
 async def no_name(message: types.Message):
     """
     Asks the user to provide their name.
@@ -1501,7 +1772,7 @@ async def no_subscription(message: types.Message):
     Asks the user to subscribe the channel.
     """
 
-    latest_channel = channel.get_channel()
+    latest_channel = await channel.get_channel()
 
     text = "Hurmatli foydalanuvchi botdan foydalanishni davom etish uchun " \
     "quyida keltirilgan havola orqali kanalimizga obuna bo'lishingiz kerak\.\n\n%s" % md.code('Owned by abduraxmonomonov.uz')
@@ -1512,37 +1783,48 @@ async def no_subscription(message: types.Message):
     await message.reply(text, parse_mode=types.ParseMode.MARKDOWN_V2, reply_markup=subscribeBtns)
 
 
-async def send_test_results(
-                    message: types.Message,
-                    test_: dict, 
-                    results: list | tuple,
-                    dicted_answers: dict,
-):
+async def on_shutdown(dispatcher: Dispatcher):
     """
-    Sends test results to corresponding users.
+    Stops the worker of the outbox - the messages that have not been sent yet stay pending - and the export processes.
     """
 
-    for result in results:
-        name = str(result['test_taker'])
-        taker = user_model.get_user_by_name(name)
-        user_answers = get_items_in_dict(str(result['user_answers']).split(','))
-        correct_answers = list(user_answers.items() & dicted_answers.items())
-        incorrect_answers = list(user_answers.items() - dicted_answers.items())
-        str_cor_ans = ' ✅ '.join(sorted([f'{tup[0]}\. {str(tup[1]).upper()}' for tup in correct_answers]))
-        str_inc_ans = ' ❌ '.join(sorted([f'{tup[0]}\. {str(tup[1]).upper()}' for tup in incorrect_answers]))
-        str_cor_ans += ' ✅ '
-        str_inc_ans += ' ❌ '
-        msg_to_taker = f"{test_['test_id']} raqamli test yakunlandi\.\n\n" \
-        f"Test topshiruvchi: {name}\n" \
-        f"To'g'ri javoblar\({len(correct_answers)}\):\n\n {str_cor_ans}\n\n" \
-        f"Noto'g'ri javoblar\({len(incorrect_answers)}\):\n\n {str_inc_ans}\n\n" \
-        f"{md.code('Owned by abduraxmonomonov.uz')}"
-        await bot.send_message(taker['chat_id'], msg_to_taker, parse_mode=types.ParseMode.MARKDOWN_V2)
-        await message.answer(
-            "Test yakunlandi natijalarni menyu orqali ko'rishingiz mumkin 🙂\n\n" \
-            f"{md.code('Owned by abduraxmonomonov.uz')}",
-            parse_mode=types.ParseMode.MARKDOWN_V2,
-        )
+    if outbox_worker is not None:
+        outbox_worker.cancel()
+    shutdown_export_executor()
+
+
+async def on_startup(dispatcher: Dispatcher):
+    """
+    Starts the worker of the outbox, which also sends the messages left pending before a restart.
+    """
+
+    global outbox_worker
+    outbox_worker = asyncio.create_task(outbox.run())
+
+
+async def send_test_results(message: types.Message, test_: dict) -> bool:
+    """
+    Sends test results to corresponding users through the outbox, and then a summary of the delivery to the request user.
+
+    The results are read and queued chunk by chunk, see TestResult.iter_results_with_recipients.
+    :returns: False without sending anything when there are no results to send, otherwise True.
+    """
+
+    report = await outbox.deliver(
+        make_result_messages(test_, results) 
+        async for results in test_results.iter_results_with_recipients(test_['test_id'])
+    )
+    if not sum(report.values()):
+        return False
+    await message.answer(
+        "Test yakunlandi natijalarni menyu orqali ko'rishingiz mumkin 🙂\n\n" \
+        f"Natijalar yuborildi: {report['delivered']} ✅\n" \
+        f"Yuborilmadi: {report['failed']} ❌\n" \
+        f"Navbatda: {report['pending']} ⏳\n\n" \
+        f"{md.code('Owned by abduraxmonomonov.uz')}",
+        parse_mode=types.ParseMode.MARKDOWN_V2,
+    )
+    return True
 
 
 async def send_user_info(message: types.Message, user: dict):
@@ -1620,4 +1902,5 @@ async def unknown_command(message: types.Message):
 
 
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True)
+    prepare_database()
+    executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
@@ -0,0 +1,199 @@
+"""
+Scoring of test submissions.
+
+Answer keys and submissions are kept as byte strings with one lower case letter per question, so that a whole
+submission is compared with the key in a single pass and no per-question dictionaries are built.
+"""
+from operator import eq
+import threading
+
+
+class Leaderboard:
+    """
+    A class for ranking the takers of a test by the number of correct answers as their results come in.
+
+    Takers are kept in a bucket per score and the sizes of the buckets in a Fenwick tree, so the rank of a score 
+    and the start of a page are found in O(log Q) for a test of Q questions, without sorting the results.
+    Takers with the same score share the rank - one plus the number of takers with a higher score - 
+    and are listed in the order they were added. The leaderboard can be used from several threads at once.
+    """
+
+    def __init__(self, questions_length: int):
+        self.questions_length = questions_length
+        # Bucket i holds the takers with questions_length - i correct answers, so the best ones come first.
+        self._buckets = [[] for _ in range(questions_length + 1)]
+        # Fenwick tree of the bucket sizes, 1-based.
+        self._tree = [0] * (questions_length + 2)
+        self._count = 0
+        # Keys of the added results, see the add method.
+        self._keys = set()
+        self._lock = threading.Lock()
+
+
+    def __len__(self) -> int:
+        return self._count
+
+
+    def add(self, taker, score: int, key=None) -> int:
+        """
+        Adds the result of the taker and returns their rank.
+
+        Pass a key - e.g. the chat id of the taker - to add the result only once, 
+        when it is added again with the same key only the rank is returned.
+        """
+
+        position = self._position(score)
+        with self._lock:
+            if key is not None:
+                if key in self._keys:
+                    return self._count_before(position) + 1
+                self._keys.add(key)
+            self._buckets[position].append(taker)
+            index = position + 1
+            while index < len(self._tree):
+                self._tree[index] += 1
+                index += index & -index
+            self._count += 1
+            return self._count_before(position) + 1
+
+
+    def page(self, offset: int, limit: int) -> list:
+        """
+        Returns at most LIMIT takers starting from the given offset, the best ones first.
+
+        :returns: A list of dictionaries containing rank, test_taker and correct_answers, 
+        the same as TestResult.get_results_page.
+        """
+
+        with self._lock:
+            if offset >= self._count or limit < 1:
+                return []
+            position, skip = self._find(offset)
+            rank = offset - skip + 1
+            results = []
+            while len(results) < limit and position < len(self._buckets):
+                bucket = self._buckets[position]
+                for taker in bucket[skip:skip + limit - len(results)]:
+                    results.append({
+                        'rank': rank,
+                        'test_taker': taker,
+                        'correct_answers': self.questions_length - position,
+                    })
+                rank += len(bucket)
+                position += 1
+                skip = 0
+            return results
+
+
+    def rank(self, score: int) -> int:
+        """
+        Returns the rank a taker with the given score has.
+        """
+
+        with self._lock:
+            return self._count_before(self._position(score)) + 1
+
+
+    def _count_before(self, position: int) -> int:
+        """
+        Returns the number of takers in the buckets before the given one, that is with a higher score.
+        """
+
+        count = 0
+        index = position
+        while index > 0:
+            count += self._tree[index]
+            index -= index & -index
+        return count
+
+
+    def _find(self, offset: int) -> tuple:
+        """
+        Finds the bucket of the taker at the given offset.
+
+        :returns: A tuple of the bucket position and the offset of the taker inside the bucket.
+        """
+
+        position = 0
+        remaining = offset
+        step = 1 << (len(self._tree) - 1).bit_length()
+        while step:
+            index = position + step
+            if index < len(self._tree) and self._tree[index] <= remaining:
+                position = index
+                remaining -= self._tree[index]
+            step >>= 1
+        return position, remaining
+
+
+    def _position(self, score: int) -> int:
+        """
+        Returns the bucket of the score, scores out of range are put into the nearest bucket.
+        """
+
+        return self.questions_length - min(max(int(score), 0), self.questions_length)
+
+
+def decode_answers(answers: bytes, separator: str = ',') -> str:
+    """
+    Converts answers encoded by encode_answers back to a string of letters separated by the separator.
+    """
+
+    return separator.join(answers.decode('ascii'))
+
+
+def encode_answers(answers: str | bytes, length: int = None) -> bytes:
+    """
+    Converts the answers - either a string of letters ('abcd') or letters separated by comma ('a,b,c,d') -
+    to a byte string of one lower case letter per question.
+
+    Characters that are not ASCII are replaced by '?', so that every character takes one byte and never
+    matches a correct answer. When the length is given, the result is cut or padded with '?' to that length,
+    which is useful for answers saved before they were validated.
+    """
+
+    if isinstance(answers, bytes):
+        answers = answers.decode('ascii', errors='replace')
+    encoded = str(answers).replace(',', '').lower().encode('ascii', errors='replace')
+    return encoded if length is None else encoded[:length].ljust(length, b'?')
+
+
+def grade(answer_key: bytes, submission: bytes) -> dict:
+    """
+    Compares the submission with the answer key.
+
+    NOTE: the length of the submission should correspond to the length of the answer key, otherwise ValueError is raised.
+    :returns: A dictionary containing the number of correct and incorrect answers, and the mask - a byte string
+    with 1 for every correctly answered question and 0 for the rest.
+    """
+
+    if len(submission) != len(answer_key):
+        raise ValueError('Invalid number of answers! The length of the submission and the answer key does not correspond.')
+    mask = bytes(map(eq, answer_key, submission))
+    correct = mask.count(1)
+    return {
+        'correct': correct,
+        'incorrect': len(answer_key) - correct,
+        'mask': mask,
+    }
+
+
+def grade_many(answer_key: bytes, submissions: list | tuple) -> list:
+    """
+    Compares many submissions with the same answer key and returns the results of grade in the same order.
+    """
+
+    return [grade(answer_key, submission) for submission in submissions]
+
+
+def split_by_mask(submission: bytes, mask: bytes) -> tuple:
+    """
+    Splits the answers of a submission into the correct and incorrect ones.
+
+    :returns: A tuple of two lists - the correct and incorrect answers - of (question number, letter) pairs.
+    """
+
+    correct, incorrect = [], []
+    for index, (letter, is_correct) in enumerate(zip(submission.decode('ascii'), mask)):
+        (correct if is_correct else incorrect).append((index + 1, letter))
+    return correct, incorrect